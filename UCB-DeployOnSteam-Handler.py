@@ -1,16 +1,46 @@
-import boto3
 import time
 import os
 import re
 import socket
 import json
+import hashlib
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 region = os.environ['REGION_ID']
-ec2instance = os.environ['INSTANCE_ID']
+# several instances (comma separated) can be started to process the packages as S3 jobs: their UCB-steam.config
+# must set jobs.mode to worker, otherwise each of them deploys the same packages
+ec2instances = os.environ['INSTANCE_ID'].split(',')
 s3bucket = os.environ['S3_BUCKET']
+# the artifact of each finished build is copied to the S3 backup of UCB-steam.py as soon as its webhook arrives:
+# inline (in this invocation), thread (local tests) or lambda (asynchronous invocation of this function, its role
+# needs lambda:InvokeFunction on itself), none to disable
+prefetch_executor = os.environ.get('PREFETCH_EXECUTOR', 'lambda' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'inline')
+prefetch_part_size = int(os.environ.get('PREFETCH_PART_SIZE', '64')) * 1048576
+prefetch_threads = int(os.environ.get('PREFETCH_THREADS', '4'))
+
+# boto3 is imported on the first call needing AWS (a rejected request returns without it) and the clients are kept
+# for the next invocations of the same container
+AWS_CLIENTS = dict()
+
+def aws_client(service, resource=False):
+    key = (service, resource)
+    if key not in AWS_CLIENTS:
+        import boto3
+        if resource:
+            AWS_CLIENTS[key] = boto3.resource(service, region_name=region)
+        else:
+            AWS_CLIENTS[key] = boto3.client(service, region_name=region)
+    return AWS_CLIENTS[key]
 
 def lambda_handler(event, context):
     print(event);
+    if 'prefetch' in event:
+        # asynchronous invocation made by the lambda prefetch executor
+        prefetch_artifact(event['prefetch'])
+        return "Done"
+
     if event['body'] is None:
         print(f'Nothing provided within the request')
         return False
@@ -32,23 +62,30 @@ def lambda_handler(event, context):
         print(f'Missing branch')
         return False
     
+    request = get_prefetch_request(body)
+    if request is not None and prefetch_executor != 'none':
+        PREFETCH_EXECUTORS[prefetch_executor](request, context)
+
     s3_path = "UCB/steam-parameters/UCB-parameters.conf"
     stringtowrite = branch + ",0.31"
     send_string_to_s3file(s3_path, stringtowrite)
     
-    result = start_instance(ec2instance)
-    if result == False:
-        print(f'Startup of Instance {ec2instance} failed')
-        return False
-    else:
-        print(f'Instance {ec2instance} started')
+    for ec2instance in ec2instances:
+        result = start_instance(ec2instance.strip())
+        if result == False:
+            print(f'Startup of Instance {ec2instance} failed')
+            return False
+        else:
+            print(f'Instance {ec2instance} started')
     
     return "Done"
 
 def start_instance(instanceid):
+    from botocore.exceptions import ClientError
+
     returncode = False
-    ec2 = boto3.resource('ec2')
-    ec2client = boto3.client('ec2', region_name=region)
+    ec2 = aws_client('ec2', resource=True)
+    ec2client = aws_client('ec2')
     objinstance = ec2.Instance(id=instanceid)
     
     print(f' Instance {instanceid} is in state {objinstance.state["Name"]}')
@@ -101,5 +138,105 @@ def start_instance(instanceid):
 def send_string_to_s3file(s3path, stringtowrite):
     encoded_string = stringtowrite.encode("utf-8")
 
-    s3_client = boto3.client('s3',region_name=region)
-    s3_client.put_object(Bucket=s3bucket, Key=s3path, Body=encoded_string)
\ No newline at end of file
+    s3_client = aws_client('s3')
+    s3_client.put_object(Bucket=s3bucket, Key=s3path, Body=encoded_string)
+
+def get_prefetch_request(body):
+    # the build target and the primary artifact of the finished build, None if it cannot be prefetched
+    # the branch of the key is the beginning of the build target id (ex: beta-windows-64bit), as in UCB-steam.py
+    if body.get('buildStatus', 'success') != 'success':
+        return None
+    links = body.get('links', dict())
+    match = re.search(r'/buildtargets/([^/]+)/builds/(\d+)', links.get('api_self', dict()).get('href', ''))
+    if match is None:
+        return None
+    buildtargetid, buildnumber = match.groups()
+    for artifact in links.get('artifacts', list()):
+        if (artifact.get('primary') or artifact.get('key') == 'primary') and len(artifact.get('files', list())) > 0:
+            # same key and metadata as the backup made by UCB-steam.py, which uses it instead of downloading from UCB
+            return {'url': artifact['files'][0]['href'],
+                    'key': f"UCB/unity-builds/{buildtargetid.split('-')[0]}/ucb{buildtargetid}.zip",
+                    'metadata': {'build': buildnumber, 'platform': body.get('platform', '')}}
+    return None
+
+def prefetch_artifact(request):
+    # stream the artifact from UCB to a multipart upload, its SHA-256 is computed on the way
+    s3_client = aws_client('s3')
+    print(f'Prefetching {request["key"]}...')
+    upload = s3_client.create_multipart_upload(Bucket=s3bucket, Key=request['key'])
+    hasher = hashlib.sha256()
+    size = 0
+    parts = list()
+    try:
+        with urllib.request.urlopen(request['url'], timeout=60) as response, \
+                ThreadPoolExecutor(max_workers=prefetch_threads) as executor:
+            pending = list()
+            while True:
+                data = read_part(response, prefetch_part_size)
+                if len(data) == 0:
+                    break
+                hasher.update(data)
+                size += len(data)
+                # at most one part per thread is kept in memory
+                if len(pending) >= prefetch_threads:
+                    parts.append(pending.pop(0).result())
+                pending.append(executor.submit(upload_part, s3_client, request['key'], upload['UploadId'],
+                                               len(parts) + len(pending) + 1, data))
+            for future in pending:
+                parts.append(future.result())
+        if size > 0:
+            s3_client.complete_multipart_upload(Bucket=s3bucket, Key=request['key'], UploadId=upload['UploadId'],
+                                                MultipartUpload={'Parts': parts})
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=s3bucket, Key=request['key'], UploadId=upload['UploadId'])
+        raise
+    if size == 0:
+        # a multipart upload cannot be completed without any part
+        s3_client.abort_multipart_upload(Bucket=s3bucket, Key=request['key'], UploadId=upload['UploadId'])
+        s3_client.put_object(Bucket=s3bucket, Key=request['key'], Body=b'')
+
+    # the metadata can only be set once the hash is known: server side copy over itself
+    metadata = dict(request['metadata'])
+    metadata.update({'sha256': hasher.hexdigest(), 'size': str(size)})
+    s3_client.copy({'Bucket': s3bucket, 'Key': request['key']}, s3bucket, request['key'],
+                   ExtraArgs={'Metadata': metadata, 'MetadataDirective': 'REPLACE'})
+    print(f'Prefetched {request["key"]} ({size} bytes, sha256 {metadata["sha256"]})')
+
+def read_part(response, part_size):
+    chunks = list()
+    length = 0
+    while length < part_size:
+        chunk = response.read(min(1048576, part_size - length))
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+        length += len(chunk)
+    return b''.join(chunks)
+
+def upload_part(s3_client, key, uploadid, partnumber, data):
+    part = s3_client.upload_part(Bucket=s3bucket, Key=key, UploadId=uploadid, PartNumber=partnumber, Body=data)
+    return {'ETag': part['ETag'], 'PartNumber': partnumber}
+
+def prefetch_inline(request, context):
+    try:
+        prefetch_artifact(request)
+    except Exception as e:
+        print(f'Prefetch of {request["key"]} failed: {e}')
+
+def prefetch_in_thread(request, context):
+    threading.Thread(target=prefetch_inline, args=(request, context)).start()
+
+def prefetch_in_lambda(request, context):
+    aws_client('lambda').invoke(FunctionName=context.function_name, InvocationType='Event',
+                                Payload=json.dumps({'prefetch': request}).encode('utf-8'))
+
+PREFETCH_EXECUTORS = {'inline': prefetch_inline, 'thread': prefetch_in_thread, 'lambda': prefetch_in_lambda}
+
+if __name__ == "__main__":
+    # local test of the prefetch: python UCB-DeployOnSteam-Handler.py <webhook body.json>
+    import sys
+    with open(sys.argv[1], "r") as webhookfile:
+        prefetchrequest = get_prefetch_request(json.load(webhookfile))
+    print(prefetchrequest)
+    if prefetchrequest is not None:
+        PREFETCH_EXECUTORS[prefetch_executor](prefetchrequest, None)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# exercise the S3 job leases of UCB-steam.py (JobLease) with several worker processes against a local S3 stand-in
+# python3 UCB-steam-lease-test.py [--workers=<count>] [--jobs=<count>] [--ttl=<seconds>] [--skew=<seconds>]
+# a worker is killed while it holds a lease: another worker must take the job over once the lease has expired
+# the clock of each worker is shifted by up to skew seconds: the leases must not depend on it
+import getopt
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+
+BUCKET = 'ucb-steam-lease-test'
+CRASHED_JOB = 'job-crashed'
+
+
+class S3StandIn(BaseHTTPRequestHandler):
+    # the part of the S3 API used by the leases: GET, PUT (If-Match / If-None-Match), HEAD and DELETE of objects
+    protocol_version = 'HTTP/1.1'
+    objects = dict()
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_key(self):
+        return unquote(urlparse(self.path).path).lstrip('/')
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_code(self, status, code):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self.send(status, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def do_GET(self):
+        with self.lock:
+            stored = self.objects.get(self.get_key())
+        if stored is None:
+            self.send_error_code(404, 'NoSuchKey')
+        else:
+            self.send(200, stored[0], {'ETag': stored[1]})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        key = self.get_key()
+        with self.lock:
+            stored = self.objects.get(key)
+            if self.headers.get('If-None-Match') == '*' and stored is not None:
+                self.send_error_code(412, 'PreconditionFailed')
+                return
+            if self.headers.get('If-Match') is not None:
+                if stored is None:
+                    self.send_error_code(404, 'NoSuchKey')
+                    return
+                if self.headers.get('If-Match') != stored[1]:
+                    self.send_error_code(412, 'PreconditionFailed')
+                    return
+            etag = f'"{hashlib.md5(body + str(time.time()).encode("utf-8")).hexdigest()}"'
+            self.objects[key] = (body, etag)
+        self.send(200, headers={'ETag': etag})
+
+    def do_DELETE(self):
+        with self.lock:
+            self.objects.pop(self.get_key(), None)
+        self.send(204)
+
+
+class SkewedTime:
+    # the time module with a wall clock shifted by offset seconds
+    def __init__(self, offset):
+        self.offset = offset
+
+    def time(self):
+        return time.time() + self.offset
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def load_ucb_steam(endpoint, offset):
+    # the deployment script is loaded as a module with a configuration pointing to the stand-in
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'UCB-steam.py')
+    spec = importlib.util.spec_from_file_location('ucb_steam', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.time = SkewedTime(offset)
+    module.CFG = {'aws': {'region': 'us-east-1', 's3bucket': BUCKET, 'endpoint_url': endpoint}}
+    module.DEBUG_FILE = open(os.devnull, 'wt')
+    return module
+
+
+def run_worker(index, endpoint, jobids, ttl, skew, done, events):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+    # the stand-in does not decode the aws-chunked bodies sent with the optional checksums
+    os.environ['AWS_REQUEST_CHECKSUM_CALCULATION'] = 'when_required'
+    ucbsteam = load_ucb_steam(endpoint, random.uniform(-skew, skew))
+    workerid = f"worker{index}"
+
+    if index == 0:
+        # this worker dies while it holds a lease: nobody releases it nor renews it
+        lease = ucbsteam.JobLease(BUCKET, CRASHED_JOB, workerid, ttl)
+        start = time.time()
+        if lease.acquire():
+            # the lease expires at least ttl seconds after start: the takeover must not start before
+            events.append((CRASHED_JOB, workerid, start, start + ttl))
+            os._exit(0)
+
+    deadline = time.time() + ttl * 10 + 30
+    while time.time() < deadline:
+        pending = [jobid for jobid in jobids if jobid not in done]
+        if len(pending) == 0:
+            return
+        random.shuffle(pending)
+        for jobid in pending:
+            lease = ucbsteam.JobLease(BUCKET, jobid, workerid, ttl)
+            if not lease.acquire():
+                continue
+            start = time.time()
+            if jobid in done:
+                # finished by another worker between the listing and the claim
+                lease.release()
+                continue
+            # some jobs last longer than the lease: the heartbeat must keep it
+            time.sleep(random.uniform(0.05, ttl * 1.5 if random.random() < 0.2 else 0.2))
+            end = time.time()
+            events.append((jobid, workerid, start, end))
+            if lease.is_valid():
+                done[jobid] = workerid
+            lease.release()
+        time.sleep(0.2)
+
+
+def main(argv):
+    workers = 4
+    jobcount = 20
+    ttl = 3
+    skew = 60
+    try:
+        opts, args = getopt.getopt(argv, "", ["workers=", "jobs=", "ttl=", "skew="])
+    except getopt.GetoptError:
+        print("UCB-steam-lease-test.py [--workers=<count>] [--jobs=<count>] [--ttl=<seconds>] [--skew=<seconds>]")
+        return 10
+    for option, argument in opts:
+        if option == "--workers":
+            workers = max(2, int(argument))
+        elif option == "--jobs":
+            jobcount = int(argument)
+        elif option == "--ttl":
+            ttl = float(argument)
+        elif option == "--skew":
+            skew = float(argument)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), S3StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+    jobids = [f"job-{i:03d}" for i in range(jobcount)] + [CRASHED_JOB]
+    with multiprocessing.Manager() as manager:
+        done = manager.dict()
+        events = manager.list()
+        processes = [multiprocessing.Process(target=run_worker, args=(i, endpoint, jobids, ttl, skew, done, events))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        done = dict(done)
+        events = list(events)
+    server.shutdown()
+
+    errors = list()
+    for jobid in jobids:
+        if jobid not in done:
+            errors.append(f"{jobid} was never processed")
+        holds = sorted((start, end, workerid) for eventjobid, workerid, start, end in events if eventjobid == jobid)
+        for (start, end, workerid), (nextstart, nextend, nextworkerid) in zip(holds, holds[1:]):
+            if nextstart < end:
+                errors.append(f"{jobid} was held by {workerid} and {nextworkerid} at the same time")
+    completed = [jobid for jobid, workerid, start, end in events
+                 if not (jobid == CRASHED_JOB and workerid == 'worker0')]
+    for jobid in set(completed):
+        if completed.count(jobid) > 1:
+            errors.append(f"{jobid} was processed {completed.count(jobid)} times")
+
+    for error in errors:
+        print(f"ERROR: {error}")
+    print(f"{len(done)}/{len(jobids)} jobs processed by {workers} workers (lease ttl {ttl}s, clock skew {skew}s), "
+          f"{len(errors)} errors")
+    return 1 if len(errors) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
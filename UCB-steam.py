@@ -1,38 +1,449 @@
 __version__ = "0.31"
 
+import contextlib
 import copy
+import cProfile
+import fnmatch
 import getopt
-import glob
-import logging
+import hashlib
+import importlib
+import json
 import os
+import pstats
+import random
 import re
 import shutil
+import socket
+import sqlite3
 import stat
+import subprocess
 import sys
+import tarfile
+import threading
 import time
-import urllib.request
+import tracemalloc
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from datetime import datetime
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 
-import boto3
-import requests
-import vdf
 import yaml
-from botocore.exceptions import ClientError
 from colorama import Fore, Style
 
 start_time = time.time()
 
+# time spent to import the modules loaded on first use
+STARTUP_PROFILE = dict()
+
+
+class LazyModule:
+    # module imported the first time one of its attributes is used: --help or a run without anything to upload
+    # does not pay for boto3 or requests
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            import_start = time.time()
+            self.module = importlib.import_module(self.name)
+            STARTUP_PROFILE.setdefault(self.name, time.time() - import_start)
+        return getattr(self.module, attribute)
+
+
+boto3 = LazyModule('boto3')
+boto3_transfer = LazyModule('boto3.s3.transfer')
+botocore_config = LazyModule('botocore.config')
+botocore_exceptions = LazyModule('botocore.exceptions')
+requests = LazyModule('requests')
+vdf = LazyModule('vdf')
+
 LOG_ERROR = 0
 LOG_WARNING = 1
 LOG_INFO = 2
 LOG_SUCCESS = 3
 
+LOG_LOCK = threading.Lock()
+# prefix and unfinished line of the threads logging through log_context()
+LOG_CONTEXT = threading.local()
+
 global DEBUG_FILE
 global DEBUG_FILE_NAME
 
 global CFG
 
+SHORT_OPTIONS = "hldocsfip:b:lv:t:u:a:"
+LONG_OPTIONS = ["help", "nolive", "nodownload", "noupload", "noclean", "noshutdown", "noemail", "force", "install",
+                "simulate", "platform=", "branch=", "version=", "steamuser=", "steampassword=", "trigger", "gitbranch=",
+                "wait", "enqueue", "worker", "noresume", "stats", "profilestartup", "from-backup", "profile"]
+
+BUILD_STATUS_BUILDING = ('queued', 'sentToBuilder', 'started', 'restarted')
+
+JOBS_PREFIX = 'UCB/jobs/'
+HISTORY_KEY = 'UCB/history/UCB-steam.history.db'
+STEAMCMD_BUNDLE_PREFIX = 'UCB/steamcmd/'
+
+METRICS = dict()
+METRICS_LOCK = threading.Lock()
+
+JOURNAL = None
+JOURNAL_LOCK = threading.Lock()
+
+DEDUPLICATOR = None
+DEDUPLICATOR_LOCK = threading.Lock()
+
+# --profile: cProfile and tracemalloc reports of each stage
+PROFILE = {'enabled': False, 'top': 25}
+PROFILE_LOCK = threading.Lock()
+
+# transfers in progress, watched by the telemetry thread
+TRANSFERS = list()
+TRANSFERS_LOCK = threading.Lock()
+TRANSFERS_MONITOR = None
+
+# bandwidth shared by the transfers of this process (bandwidth section)
+GOVERNOR = None
+GOVERNOR_LOCK = threading.Lock()
+
+# concurrent stages allowed for each resource in the pipeline (pipeline.limits)
+RESOURCE_LIMITS = {'download': 2, 'extract': 1, 'backup': 2, 'steam': 1, 'butler': 2}
+RESOURCES = dict()
+RESOURCES_LOCK = threading.Lock()
+
+# version of the steamcmd bundle restored on this instance and ETag of the manifest it comes from
+STEAMCMD_BUNDLE = {'checked': False, 'version': None, 'etag': None}
+
+UCB_CLIENT = None
+UCB_CLIENT_LOCK = threading.Lock()
+
+
+class UCBClient:
+    # shared HTTP client for the Unity Cloud Build API: pooled session, timeouts and retries with jittered backoff
+    def __init__(self, connect_timeout=10, read_timeout=60, max_retries=4, backoff_base=1.0, backoff_max=30.0,
+                 pool_size=10):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.retry_count = 0
+        self.error_count = 0
+        self.latencies = list()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        # POST requests are only retried when UCB did not process them (429 or connection not established)
+        # unless the caller tells they are idempotent
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD', 'DELETE')
+        if 'headers' not in kwargs:
+            kwargs['headers'] = headers()
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = (self.connect_timeout, self.read_timeout)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            request_start = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self.record(time.time() - request_start, True)
+                retryable = isinstance(e, requests.exceptions.ConnectTimeout) or (
+                        idempotent and isinstance(e, (requests.exceptions.ConnectionError,
+                                                      requests.exceptions.Timeout)))
+                if not retryable or attempt > self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                log(f"UCB API {method} {url} failed ({e}), retrying in {delay:.1f}s...", logtype=LOG_WARNING)
+                time.sleep(delay)
+                continue
+
+            self.record(time.time() - request_start, not response.ok)
+            if attempt <= self.max_retries and (
+                    response.status_code == 429 or (idempotent and response.status_code >= 500)):
+                delay = self.backoff(attempt, response.headers.get('Retry-After'))
+                log(f"UCB API {method} {url} returned {response.status_code}, retrying in {delay:.1f}s...",
+                    logtype=LOG_WARNING)
+                time.sleep(delay)
+                continue
+
+            return response
+
+    def backoff(self, attempt, retry_after=None):
+        # full jitter exponential backoff, never shorter than the Retry-After header sent by UCB
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+        if retry_after is not None:
+            try:
+                delay = max(delay, min(self.backoff_max, float(retry_after)))
+            except ValueError:
+                pass
+        with self.lock:
+            self.retry_count += 1
+        return delay
+
+    def record(self, latency, failed):
+        with self.lock:
+            self.request_count += 1
+            self.latencies.append(latency)
+            if failed:
+                self.error_count += 1
+
+    def get_statistics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            statistics = {'requests': self.request_count, 'retries': self.retry_count, 'errors': self.error_count,
+                          'latency_avg': 0.0, 'latency_p95': 0.0, 'latency_max': 0.0}
+            if len(latencies) > 0:
+                statistics['latency_avg'] = sum(latencies) / len(latencies)
+                statistics['latency_p95'] = percentile(latencies, 0.95)
+                statistics['latency_max'] = latencies[-1]
+        return statistics
+
+
+def ucb_client():
+    global UCB_CLIENT
+    with UCB_CLIENT_LOCK:
+        if UCB_CLIENT is None:
+            UCB_CLIENT = UCBClient(connect_timeout=get_config_value(['unity', 'http', 'connect_timeout'], 10),
+                                   read_timeout=get_config_value(['unity', 'http', 'read_timeout'], 60),
+                                   max_retries=get_config_value(['unity', 'http', 'max_retries'], 4),
+                                   backoff_base=get_config_value(['unity', 'http', 'backoff_base'], 1.0),
+                                   backoff_max=get_config_value(['unity', 'http', 'backoff_max'], 30.0),
+                                   pool_size=get_config_value(['unity', 'http', 'pool_size'], 10))
+        return UCB_CLIENT
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def record_metric(section, key, values):
+    # store values in the run metrics (ex: record_metric('artifacts', 'prod-windows-64bit', {'size': 1024}))
+    global METRICS
+    with METRICS_LOCK:
+        if section not in METRICS:
+            METRICS[section] = dict()
+        if key not in METRICS[section]:
+            METRICS[section][key] = dict()
+        METRICS[section][key].update(values)
+
+
+def get_metric_name(name):
+    # the packages, the depots and the UCB stages of the projects can have the same names: they are told apart by
+    # the project
+    project = get_config_value(['project'])
+    return name if project is None else f"{project}/{name}"
+
+
+def record_stage(key, stage, start):
+    # store the duration of a pipeline stage started at start (ex: record_stage('prod-windows-64bit', 'download', start))
+    record_metric('stages', key, {stage: time.time() - start})
+
+
+class StageProfiler:
+    # profile a stage with cProfile and tracemalloc, the reports are written next to the HTML log:
+    # <log>_<stage>.prof (pstats dump) and <log>_<stage>.txt (top functions and top allocations)
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+        self.snapshot = None
+
+    def __enter__(self):
+        # a single profiler can be active at a time: the stages running in parallel are not profiled
+        if not PROFILE_LOCK.acquire(blocking=False):
+            return self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.snapshot = tracemalloc.take_snapshot()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is None:
+            return False
+        try:
+            self.profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+            differences = snapshot.filter_traces(filters).compare_to(self.snapshot.filter_traces(filters), 'lineno')
+
+            reportpath = os.path.splitext(DEBUG_FILE_NAME)[0] + '_' + re.sub(r'[^\w.-]', '_', self.name)
+            self.profiler.dump_stats(reportpath + '.prof')
+            with open(reportpath + '.txt', "wt") as file:
+                file.write(f"Stage {self.name}\n\nTop {PROFILE['top']} functions (cumulative time):\n")
+                pstats.Stats(self.profiler, stream=file).sort_stats('cumulative').print_stats(PROFILE['top'])
+                current, peak = tracemalloc.get_traced_memory()
+                file.write(f"Top {PROFILE['top']} allocations (current {current / 1048576:.1f}MB, "
+                           f"peak {peak / 1048576:.1f}MB):\n")
+                for difference in differences[:PROFILE['top']]:
+                    file.write(f"{difference}\n")
+        except OSError as e:
+            log(f"The profile of {self.name} cannot be written: {e}", logtype=LOG_WARNING)
+        finally:
+            PROFILE_LOCK.release()
+        return False
+
+
+def profile_stage(name):
+    # nothing is done when --profile is not used
+    if not PROFILE['enabled']:
+        return contextlib.nullcontext()
+    return StageProfiler(name)
+
+
+def log_startup_profile(interpreter_time, config_time):
+    # --profilestartup: CPU time of the interpreter start and the eager imports, then wall time of the rest
+    log(f"Startup: interpreter and eager imports {interpreter_time * 1000:.0f}ms (CPU), "
+        f"configuration {config_time * 1000:.0f}ms")
+    for name, duration in sorted(STARTUP_PROFILE.items(), key=lambda item: -item[1]):
+        log(f" Import of {name} on first use: {duration * 1000:.0f}ms", nodate=True)
+
+
+def log_run_metrics():
+    global METRICS
+    if UCB_CLIENT is not None:
+        statistics = UCB_CLIENT.get_statistics()
+        METRICS['ucb_api'] = statistics
+        log(f"UCB API: {statistics['requests']} requests ({statistics['retries']} retries, {statistics['errors']} errors), "
+            f"latency avg {statistics['latency_avg'] * 1000:.0f}ms / p95 {statistics['latency_p95'] * 1000:.0f}ms / "
+            f"max {statistics['latency_max'] * 1000:.0f}ms")
+
+    for buildtargetid, artifact in METRICS.get('artifacts', dict()).items():
+        log(f"Artifact {buildtargetid}: build #{artifact.get('build')}, {artifact.get('size', 0) / 1048576:.1f}MB, "
+            f"sha256 {artifact.get('sha256')}")
+
+    for upload in METRICS.get('uploads', dict()).values():
+        details = list()
+        if upload.get('new_bytes') is not None:
+            details.append(f"{upload['new_bytes'] / 1048576:.1f}MB new")
+        if upload.get('reused_bytes') is not None:
+            details.append(f"{upload['reused_bytes'] / 1048576:.1f}MB reused")
+        if upload.get('new_chunks') is not None or upload.get('reused_chunks') is not None:
+            details.append(f"{upload.get('new_chunks', 0)} new / {upload.get('reused_chunks', 0)} reused chunks")
+        if upload.get('patch_bytes') is not None:
+            details.append(f"{upload['patch_bytes'] / 1048576:.1f}MB patch")
+        details.append(f"{upload.get('duration', 0):.0f}s")
+        if upload.get('upload_rate') is not None:
+            details.append(f"{upload['upload_rate'] / 1048576:.1f}MB/s")
+        for field in ('build_id', 'manifest'):
+            if upload.get(field) is not None:
+                details.append(f"{field.replace('_', ' ')} {upload[field]}")
+        log(f"Upload {upload['name']} to {upload['store']}: {', '.join(details)}")
+
+
+class Journal:
+    # durable record of the stages completed for each build target and package, used to resume an interrupted run
+    # targets: {buildtargetid: {'build': 12, 'sha256': ..., 'size': ..., 'stages': {'downloaded': <time>, ...}}}
+    # packages: {package: {'builds': {buildtargetid: 12}, 'stages': {'steam': <time>, ...}}}
+    # deployed: {package: {buildtargetid: 12}}, the last builds deployed, kept when the package is cleaned
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'targets': dict(), 'packages': dict()}
+        if os.path.exists(path):
+            try:
+                with open(path, "rt") as file:
+                    self.data = json.load(file)
+            except (OSError, ValueError) as e:
+                log(f"The journal {path} cannot be read and is ignored: {e}", logtype=LOG_WARNING)
+
+    def save(self):
+        # write then rename: the journal is never left half written
+        temppath = self.path + '.tmp'
+        with open(temppath, "wt") as file:
+            json.dump(self.data, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temppath, self.path)
+
+    def reset(self):
+        with self.lock:
+            self.data = {'targets': dict(), 'packages': dict(), 'deployed': self.data.get('deployed', dict())}
+            self.save()
+
+    def get_target(self, buildtargetid, build):
+        # the stages recorded for another build of the build target are forgotten
+        with self.lock:
+            target = self.data['targets'].get(buildtargetid)
+            if target is None or target['build'] != build:
+                target = {'build': build, 'stages': dict()}
+                self.data['targets'][buildtargetid] = target
+            return dict(target)
+
+    def is_target_done(self, buildtargetid, build, stage):
+        with self.lock:
+            target = self.data['targets'].get(buildtargetid)
+            return target is not None and target['build'] == build and stage in target['stages']
+
+    def mark_target(self, buildtargetid, build, stage, values=None):
+        with self.lock:
+            target = self.data['targets'].get(buildtargetid)
+            if target is None or target['build'] != build:
+                target = {'build': build, 'stages': dict()}
+                self.data['targets'][buildtargetid] = target
+            if values is not None:
+                target.update(values)
+            target['stages'][stage] = time.time()
+            self.save()
+
+    def is_package_done(self, package, buildnumbers, stage):
+        with self.lock:
+            packagevalue = self.data['packages'].get(package)
+            return packagevalue is not None and packagevalue['builds'] == buildnumbers and stage in packagevalue[
+                'stages']
+
+    def mark_package(self, package, buildnumbers, stage):
+        with self.lock:
+            packagevalue = self.data['packages'].get(package)
+            if packagevalue is None or packagevalue['builds'] != buildnumbers:
+                packagevalue = {'builds': buildnumbers, 'stages': dict()}
+                self.data['packages'][package] = packagevalue
+            packagevalue['stages'][stage] = time.time()
+            self.save()
+
+    def is_deployed(self, package, buildnumbers):
+        with self.lock:
+            return self.data.get('deployed', dict()).get(package) == buildnumbers
+
+    def mark_deployed(self, package, buildnumbers):
+        with self.lock:
+            self.data.setdefault('deployed', dict())[package] = buildnumbers
+            self.save()
+
+    def forget_package(self, package, buildtargetids):
+        # the package is cleaned: nothing is left to resume
+        with self.lock:
+            self.data['packages'].pop(package, None)
+            for buildtargetid in buildtargetids:
+                self.data['targets'].pop(buildtargetid, None)
+            self.save()
+
+
+def get_journal():
+    global JOURNAL
+    with JOURNAL_LOCK:
+        if JOURNAL is None:
+            JOURNAL = Journal(get_config_value(['journal'], CFG['basepath'] + '/UCB-steam.journal.json'))
+        return JOURNAL
+
 
 def api_url():
     global CFG
@@ -45,18 +456,92 @@ def headers():
     return {'Authorization': 'Basic {}'.format(CFG['unity']['api_key'])}
 
 
-def create_new_build_target(data, branch, user):
-    name_limit = 64 - 17 - len(user)
+def get_config_value(keys, default=None):
+    # get an optional value from the configuration (ex: ['unity', 'cleanup', 'batch_size'])
+    global CFG
+    value = CFG
+    for key in keys:
+        if not isinstance(value, dict) or key not in value or value[key] is None:
+            return default
+        value = value[key]
+    return value
+
+
+def merge_config(base, override):
+    # the dictionaries are merged recursively, any other value of override replaces the one of base
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_config(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def get_project_configs(config):
+    # projects: one configuration per project, made of the settings shared by all of them and the project ones
+    # an empty list when the configuration has a single project, None when the projects are not valid
+    if 'projects' not in config:
+        return list()
+    base = {key: value for key, value in config.items() if key != 'projects'}
+    projects = list()
+    buildtargetids = dict()
+    for project in config['projects']:
+        if 'name' not in project:
+            log("A project of the configuration has no name", logtype=LOG_ERROR)
+            return None
+        projectconfig = merge_config(copy.deepcopy(base), {key: value for key, value in project.items()
+                                                           if key != 'name'})
+        projectconfig['project'] = project['name']
+        if 'journal' not in project:
+            # the packages of the projects can have the same names: each project resumes from its own journal
+            root, extension = os.path.splitext(base.get('journal', projectconfig['basepath'] +
+                                                        '/UCB-steam.journal.json'))
+            projectconfig['journal'] = f"{root}.{project['name']}{extension}"
+        # the build directories, the S3 backups and the run metrics are named after the build targets
+        for buildtarget in projectconfig.get('buildtargets') or list():
+            for buildtargetid in buildtarget.keys():
+                if buildtargetid in buildtargetids:
+                    log(f"The build target {buildtargetid} is used by the projects {buildtargetids[buildtargetid]} "
+                        f"and {project['name']}", logtype=LOG_ERROR)
+                    return None
+                buildtargetids[buildtargetid] = project['name']
+        projects.append(projectconfig)
+    return projects
+
+
+def get_jobs_prefix():
+    # the jobs of each project are kept apart
+    project = get_config_value(['project'])
+    return JOBS_PREFIX if project is None else f"{JOBS_PREFIX}{project}/"
+
+
+def parse_ucb_date(value):
+    # UCB dates are UTC dates formatted like 2021-10-20T08:12:54.126Z
+    if value is None or value == "":
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        return None
+
+
+def create_new_build_target(data, branch, user, suffix=""):
+    name_limit = 64 - 17 - len(user) - len(suffix)
     name = re.sub("[^0-9a-zA-Z]+", "-", branch)[0:name_limit]
 
-    data['name'] = 'Autobuild of {} by {}'.format(name, user)
+    data['name'] = 'Autobuild of {} by {}{}'.format(name, user, suffix)
     data['settings']['scm']['branch'] = branch
 
     url = '{}/buildtargets'.format(api_url())
-    response = requests.post(url, headers=headers(), json=data)
+    try:
+        response = ucb_client().post(url, json=data)
+    except requests.exceptions.RequestException as e:
+        log(f"Creating build target {data['name']} failed: {e}", logtype=LOG_ERROR)
+        return None, data['name']
 
     if not response.ok:
-        logging.error("Creating build target " + data['name'] + " failed", response.text)
+        log(f"Creating build target {data['name']} failed: {response.text}", logtype=LOG_ERROR)
+        return None, data['name']
 
     info = response.json()
     return info['buildtargetid'], data['name']
@@ -64,13 +549,105 @@ def create_new_build_target(data, branch, user):
 
 def delete_build_target(buildtargetid):
     url = '{}/buildtargets/{}'.format(api_url(), buildtargetid)
-    requests.delete(url, headers=headers())
+    try:
+        response = ucb_client().delete(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Deleting build target {buildtargetid} failed: {e}", logtype=LOG_ERROR)
+        return False
+
+    if not response.ok:
+        log(f"Deleting build target {buildtargetid} failed: {response.text}", logtype=LOG_ERROR)
+        return False
+
+    return True
 
 
 def start_build(buildtargetid):
     url = '{}/buildtargets/{}/builds'.format(api_url(), buildtargetid)
     data = {'clean': True}
-    requests.post(url, headers=headers(), json=data)
+    try:
+        response = ucb_client().post(url, json=data)
+    except requests.exceptions.RequestException as e:
+        log(f"Starting build for {buildtargetid} failed: {e}", logtype=LOG_ERROR)
+        return None
+
+    if not response.ok:
+        log(f"Starting build for {buildtargetid} failed: {response.text}", logtype=LOG_ERROR)
+        return None
+
+    # UCB answers with the list of the builds created
+    info = response.json()
+    if isinstance(info, list):
+        info = info[0] if len(info) > 0 else dict()
+    if 'build' not in info:
+        log(f"Starting build for {buildtargetid} failed: {info.get('error', 'no build number returned')}",
+            logtype=LOG_ERROR)
+        return None
+
+    return info['build']
+
+
+def get_build_target(buildtargetid):
+    url = '{}/buildtargets/{}'.format(api_url(), buildtargetid)
+    try:
+        response = ucb_client().get(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Getting build target {buildtargetid} failed: {e}", logtype=LOG_ERROR)
+        return None
+
+    if not response.ok:
+        log(f"Getting build target {buildtargetid} failed: {response.text}", logtype=LOG_ERROR)
+        return None
+
+    return response.json()
+
+
+def get_build(buildtargetid, build):
+    url = '{}/buildtargets/{}/builds/{}'.format(api_url(), buildtargetid, build)
+    try:
+        response = ucb_client().get(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Getting build #{build} of {buildtargetid} failed: {e}", logtype=LOG_ERROR)
+        return None
+
+    if not response.ok:
+        log(f"Getting build #{build} of {buildtargetid} failed: {response.text}", logtype=LOG_ERROR)
+        return None
+
+    return response.json()
+
+
+def cancel_build(buildtargetid, build):
+    url = '{}/buildtargets/{}/builds/{}'.format(api_url(), buildtargetid, build)
+    try:
+        response = ucb_client().delete(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Cancelling build #{build} of {buildtargetid} failed: {e}", logtype=LOG_ERROR)
+        return False
+
+    if not response.ok:
+        log(f"Cancelling build #{build} of {buildtargetid} failed: {response.text}", logtype=LOG_ERROR)
+        return False
+
+    return True
+
+
+def clone_build_target(buildtargetid, branch, user):
+    # create a copy of a configured build target building another git branch
+    buildtarget = get_build_target(buildtargetid)
+    if buildtarget is None:
+        return None
+
+    data = dict()
+    for key in ('platform', 'enabled', 'settings', 'credentials'):
+        if key in buildtarget:
+            data[key] = copy.deepcopy(buildtarget[key])
+    if 'scm' not in data.get('settings', dict()):
+        log(f"Build target {buildtargetid} has no scm settings and cannot be cloned", logtype=LOG_ERROR)
+        return None
+
+    clonebuildtargetid, clonename = create_new_build_target(data, branch, user, f" ({buildtargetid})")
+    return clonebuildtargetid
 
 
 def create_build_url(buildtarget_id, build_number):
@@ -82,10 +659,15 @@ def create_build_url(buildtarget_id, build_number):
 
 def get_last_builds(branch="", platform=""):
     url = '{}/buildtargets?include_last_success=true'.format(api_url())
-    response = requests.get(url, headers=headers())
 
     datatemp = []
 
+    try:
+        response = ucb_client().get(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Getting build template failed: {e}", logtype=LOG_ERROR)
+        return datatemp
+
     if not response.ok:
         log(f"Getting build template failed: {response.text}", logtype=LOG_ERROR)
         return datatemp
@@ -138,10 +720,15 @@ def get_last_builds(branch="", platform=""):
 
 def get_all_builds(buildtarget="", platform=""):
     url = '{}/buildtargets/_all/builds'.format(api_url())
-    response = requests.get(url, headers=headers())
 
     datatemp = []
 
+    try:
+        response = ucb_client().get(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Getting build template failed: {e}", logtype=LOG_ERROR)
+        return datatemp
+
     if not response.ok:
         log(f"Getting build template failed: {response.text}", logtype=LOG_ERROR)
         return datatemp
@@ -184,19 +771,137 @@ def get_all_builds(buildtarget="", platform=""):
     return datatemp
 
 
+def get_target_builds(buildtargetid, count):
+    # most recent builds of a build target, None if they cannot be retrieved
+    url = '{}/buildtargets/{}/builds?per_page={}&page=1'.format(api_url(), buildtargetid, count)
+    try:
+        response = ucb_client().get(url)
+    except requests.exceptions.RequestException as e:
+        log(f"Getting the builds of {buildtargetid} failed: {e}", logtype=LOG_ERROR)
+        return None
+
+    if response.status_code == 404:
+        log(f"The build target {buildtargetid} does not exist in UCB", logtype=LOG_WARNING)
+        return list()
+    if not response.ok:
+        log(f"Getting the builds of {buildtargetid} failed: {response.text}", logtype=LOG_ERROR)
+        return None
+
+    builds = response.json()
+    for build in builds:
+        build.setdefault('buildtargetid', buildtargetid)
+    return builds
+
+
+def get_configured_builds(platform=""):
+    # recent builds of the configured build targets only, requested in parallel
+    global CFG
+    count = int(get_config_value(['unity', 'fetch_builds'], 25))
+    buildtargetids = list()
+    for buildtarget in CFG['buildtargets']:
+        buildtargetids.extend(buildtarget.keys())
+    if len(buildtargetids) == 0:
+        return list()
+
+    threads = int(get_config_value(['unity', 'http', 'pool_size'], 10))
+    with ThreadPoolExecutor(max_workers=min(threads, len(buildtargetids))) as executor:
+        results = list(executor.map(lambda buildtargetid: get_target_builds(buildtargetid, count), buildtargetids))
+
+    datatemp = list()
+    for builds in results:
+        if builds is None:
+            # an incomplete list could deploy a package without one of its build targets
+            return list()
+        for build in builds:
+            if "build" not in build:
+                continue
+            if platform != "" and build.get('platform') != platform:
+                continue
+            datatemp.append(build)
+    return datatemp
+
+
+def get_builds(platform=""):
+    # unity.fetch_mode: all (every build of the project in one request) or targets (configured build targets only)
+    if get_config_value(['unity', 'fetch_mode'], 'all') == 'targets':
+        return get_configured_builds(platform)
+    return get_all_builds("", platform)
+
+
 def delete_build(buildtargetid, build):
-    deleted = True
+    failed = delete_build_batch([(buildtargetid, build)])
+    return len(failed) == 0
+
+
+def delete_build_batch(batch):
     url = '{}/artifacts/delete'.format(api_url())
 
-    data = {'builds': [{"buildtargetid": buildtargetid, "build": int(build)}]}
+    data = {'builds': [{"buildtargetid": buildtargetid, "build": int(build)} for buildtargetid, build in batch]}
 
-    response = requests.post(url, headers=headers(), json=data)
+    try:
+        response = ucb_client().post(url, json=data, idempotent=True)
+        error = response.text
+    except requests.exceptions.RequestException as e:
+        response = None
+        error = str(e)
 
-    if not response.ok:
-        deleted = False
-        log(f"Deleting build target failed: {response.text}", logtype=LOG_ERROR)
+    if response is not None and response.ok:
+        return list()
+
+    # nothing is logged here: the batches run in threads while the caller has a line in progress
+    if len(batch) == 1:
+        return [(batch[0][0], batch[0][1], error)]
+
+    # UCB does not tell which build of the batch failed: retry them one by one to identify them
+    failed = list()
+    for entry in batch:
+        failed.extend(delete_build_batch([entry]))
+    return failed
 
-    return deleted
+
+def delete_builds(buildstodelete, batch_size=50, threads=4):
+    # buildstodelete is a list of (buildtargetid, build) tuples, the failed ones are returned as
+    # (buildtargetid, build, error) tuples
+    batch_size = max(1, int(batch_size))
+    batches = [buildstodelete[i:i + batch_size] for i in range(0, len(buildstodelete), batch_size)]
+
+    failed = list()
+    if len(batches) == 0:
+        return failed
+
+    with ThreadPoolExecutor(max_workers=max(1, min(int(threads), len(batches)))) as executor:
+        for batchfailed in executor.map(delete_build_batch, batches):
+            failed.extend(batchfailed)
+
+    return failed
+
+
+def select_builds_to_delete(builds, keep_success_count=0, failure_retention_days=0):
+    # apply the retention policy on the builds of the buildtargets to clean
+    # keep_success_count: number of most recent successful builds kept per buildtarget
+    # failure_retention_days: failed or canceled builds younger than this number of days are kept
+    buildstodelete = list()
+    successcount = dict()
+    currentdate = datetime.utcnow()
+
+    for build in sorted(builds, key=lambda item: int(item['build']), reverse=True):
+        buildtargetid = build['buildtargetid']
+
+        if build['buildStatus'] == 'success':
+            successcount[buildtargetid] = successcount.get(buildtargetid, 0) + 1
+            if successcount[buildtargetid] <= keep_success_count:
+                continue
+        elif build['buildStatus'] == 'failure' or build['buildStatus'] == 'canceled':
+            if failure_retention_days > 0:
+                builddate = parse_ucb_date(build.get('finished'))
+                if builddate is None:
+                    builddate = parse_ucb_date(build.get('created'))
+                if builddate is not None and (currentdate - builddate).total_seconds() < failure_retention_days * 86400:
+                    continue
+
+        buildstodelete.append(build)
+
+    return buildstodelete
 
 
 def replace_in_file(file, haystack, needle):
@@ -263,7 +968,7 @@ def send_email(sender, recipients, title, message):
             Source=sender,
         )
     # Display an error if something goes wrong.
-    except ClientError as e:
+    except botocore_exceptions.ClientError as e:
         log(e.response['Error']['Message'], logtype=LOG_ERROR)
         return 461
     else:
@@ -272,27 +977,73 @@ def send_email(sender, recipients, title, message):
         return 0
 
 
+def s3_client():
+    # aws.endpoint_url allows to use a local S3 compatible server
+    # the read timeout bounds a read on a dead connection, so a stalled transfer aborted by the monitor ends quickly
+    global CFG
+    config = botocore_config.Config(connect_timeout=get_config_value(['aws', 'connect_timeout'], 10),
+                                    read_timeout=get_config_value(['aws', 'read_timeout'], 60))
+    return boto3.client("s3", region_name=CFG['aws']['region'], endpoint_url=get_config_value(['aws', 'endpoint_url']),
+                        config=config)
+
+
+def s3_get_json(bucket_name, key):
+    # return the content of a json object and its ETag, (None, None) if it does not exist
+    client = s3_client()
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=key)
+    except botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+
+def s3_put_json(bucket_name, key, data, if_match=None, if_none_match=False):
+    # conditional write of a json object, return the new ETag or None when the condition failed
+    client = s3_client()
+    extraargs = dict()
+    if if_match is not None:
+        extraargs['IfMatch'] = if_match
+    if if_none_match:
+        extraargs['IfNoneMatch'] = '*'
+    try:
+        response = client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(data).encode('utf-8'),
+                                     ContentType='application/json', **extraargs)
+    except botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey'):
+            return None
+        raise
+    return response['ETag']
+
+
 def s3_download_file(file, bucket, destination):
     global CFG
-    client = boto3.client("s3", region_name=CFG['aws']['region'])
+    client = s3_client()
+    progress = TransferProgress(f"Download of {file} from S3", bandwidthclass='restore')
     try:
-        # Provide the file information to upload.
-        response = client.download_file(
-            Filename=destination,
-            Bucket=bucket,
-            Key=file,
-        )
+        # the managed transfer is cancelled by the monitor when it stalls
+        with boto3_transfer.create_transfer_manager(client, boto3_transfer.TransferConfig()) as manager:
+            future = manager.download(bucket, file, destination,
+                                      subscribers=[boto3_transfer.ProgressCallbackInvoker(progress.update)])
+            progress.on_abort(future.cancel)
+            future.result()
         return 0
     # Display an error if something goes wrong.
-    except ClientError as e:
+    except botocore_exceptions.ClientError as e:
         log(e.response['Error']['Message'], logtype=LOG_ERROR)
         return 440
+    except (TransferStalledError, CancelledError) as e:
+        log(progress.abort_message() if progress.aborted else str(e), logtype=LOG_ERROR)
+        return 440
+    finally:
+        progress.finish()
 
 
 def s3_download_directory(directory, bucket_name, destination):
     global CFG
-    client = boto3.client("s3", region_name=CFG['aws']['region'])
-    s3 = boto3.resource("s3")
+    client = s3_client()
+    s3 = boto3.resource("s3", region_name=CFG['aws']['region'], endpoint_url=get_config_value(['aws', 'endpoint_url']))
     try:
         bucket = s3.Bucket(bucket_name)
         for obj in bucket.objects.filter(Prefix=directory):
@@ -309,31 +1060,43 @@ def s3_download_directory(directory, bucket_name, destination):
             )
         return 0
     # Display an error if something goes wrong.
-    except ClientError as e:
+    except botocore_exceptions.ClientError as e:
         log(e.response['Error']['Message'], logtype=LOG_ERROR)
         return 440
 
 
-def s3_upload_file(filetoupload, bucket_name, destination):
+def s3_upload_file(filetoupload, bucket_name, destination, metadata=None, bandwidthclass='backup'):
+    # managed transfer: big files are sent as parallel multipart uploads and the progress is reported
     global CFG
-    client = boto3.client("s3", region_name=CFG['aws']['region'])
+    client = s3_client()
+    progress = TransferProgress(f"Upload of {os.path.basename(filetoupload)} to S3", os.path.getsize(filetoupload),
+                                bandwidthclass)
     try:
-        response = client.put_object(
-            Bucket=bucket_name,
-            Key=destination,
-            Body=open(filetoupload, 'rb')
-        )
+        extraargs = dict()
+        if metadata is not None:
+            extraargs['Metadata'] = metadata
+        # the managed transfer is cancelled by the monitor when it stalls
+        with boto3_transfer.create_transfer_manager(client, boto3_transfer.TransferConfig()) as manager:
+            future = manager.upload(filetoupload, bucket_name, destination, extra_args=extraargs,
+                                    subscribers=[boto3_transfer.ProgressCallbackInvoker(progress.update)])
+            progress.on_abort(future.cancel)
+            future.result()
 
         return 0
     # Display an error if something goes wrong.
-    except ClientError as e:
+    except botocore_exceptions.ClientError as e:
         log(e.response['Error']['Message'], logtype=LOG_ERROR)
         return 450
+    except (boto3.exceptions.S3UploadFailedError, TransferStalledError, CancelledError) as e:
+        log(progress.abort_message() if progress.aborted else str(e), logtype=LOG_ERROR)
+        return 450
+    finally:
+        progress.finish()
 
 
 def s3_delete_file(bucket_name, filetodelete):
     global CFG
-    client = boto3.client("s3", region_name=CFG['aws']['region'])
+    client = s3_client()
     try:
         response = client.put_object(
             Bucket=bucket_name,
@@ -342,11 +1105,912 @@ def s3_delete_file(bucket_name, filetodelete):
 
         return 0
     # Display an error if something goes wrong.
-    except ClientError as e:
+    except botocore_exceptions.ClientError as e:
         log(e.response['Error']['Message'], logtype=LOG_ERROR)
         return 460
 
 
+class S3StreamUpload:
+    # multipart upload fed chunk by chunk, the memory used is bounded by max_buffered_parts * part_size
+    def __init__(self, bucket_name, destination, part_size=64 * 1048576, max_buffered_parts=4):
+        global CFG
+        self.client = s3_client()
+        self.bucket_name = bucket_name
+        self.destination = destination
+        self.part_size = max(5 * 1048576, int(part_size))
+        self.slots = threading.BoundedSemaphore(max_buffered_parts)
+        self.executor = ThreadPoolExecutor(max_workers=max_buffered_parts)
+        self.buffer = list()
+        self.buffersize = 0
+        self.futures = list()
+        self.upload_id = self.client.create_multipart_upload(Bucket=bucket_name, Key=destination)['UploadId']
+        # the parts share the bandwidth with the other transfers as backup traffic
+        self.governor = get_governor()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffersize += len(data)
+        if self.buffersize >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffersize == 0 and len(self.futures) > 0:
+            return
+        data = b''.join(self.buffer)
+        self.buffer = list()
+        self.buffersize = 0
+        # wait for a free slot: the download is slowed down instead of filling the memory
+        self.slots.acquire()
+        self.check()
+        self.futures.append(self.executor.submit(self.upload_part, len(self.futures) + 1, data))
+
+    def check(self):
+        # a failed part stops the download now instead of once the whole artifact is read
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def upload_part(self, part_number, data):
+        try:
+            if self.governor is not None:
+                self.governor.consume('backup', len(data))
+            response = self.client.upload_part(Bucket=self.bucket_name, Key=self.destination, PartNumber=part_number,
+                                               UploadId=self.upload_id, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def complete(self, metadata=None):
+        self.flush()
+        try:
+            parts = [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown()
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.destination, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': parts})
+        if metadata is not None:
+            # the hash is only known at the end of the stream: set the metadata with a server side copy
+            self.client.copy({'Bucket': self.bucket_name, 'Key': self.destination}, self.bucket_name, self.destination,
+                             ExtraArgs={'Metadata': metadata, 'MetadataDirective': 'REPLACE'})
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.destination, UploadId=self.upload_id)
+        except botocore_exceptions.ClientError as e:
+            log(e.response['Error']['Message'], logtype=LOG_ERROR)
+        except botocore_exceptions.BotoCoreError as e:
+            log(str(e), logtype=LOG_ERROR)
+
+
+def history_download(client, bucket_name, path):
+    # replace the local run history by the copy stored in S3, return its ETag or None if there is none
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=HISTORY_KEY)
+    except botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    temppath = path + '.tmp'
+    with open(temppath, "wb") as file:
+        shutil.copyfileobj(response['Body'], file)
+    os.replace(temppath, path)
+    return response['ETag']
+
+
+def history_connect(path):
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, duration REAL,
+            exitcode INTEGER, host TEXT, mode TEXT, platform TEXT, branch TEXT, ucb_requests INTEGER,
+            ucb_retries INTEGER, ucb_latency_p95 REAL);
+        CREATE TABLE IF NOT EXISTS artifacts (run_id INTEGER, buildtargetid TEXT, build INTEGER, version TEXT,
+            sha256 TEXT, size INTEGER, extracted_size INTEGER, download_rate REAL);
+        CREATE TABLE IF NOT EXISTS stages (run_id INTEGER, name TEXT, stage TEXT, duration REAL);
+        CREATE TABLE IF NOT EXISTS uploads (run_id INTEGER, name TEXT, store TEXT, build_id TEXT, new_bytes INTEGER,
+            reused_bytes INTEGER, duration REAL, upload_rate REAL);
+        CREATE INDEX IF NOT EXISTS artifacts_buildtargetid ON artifacts (buildtargetid, run_id);
+        CREATE INDEX IF NOT EXISTS stages_name ON stages (name, run_id);
+        CREATE INDEX IF NOT EXISTS uploads_name ON uploads (name, run_id);
+    """)
+    return connection
+
+
+def history_insert_run(connection, exitcode):
+    settings = METRICS.get('run', dict()).get('settings', dict())
+    statistics = METRICS.get('ucb_api', dict())
+    cursor = connection.execute(
+        "INSERT INTO runs (started, duration, exitcode, host, mode, platform, branch, ucb_requests, ucb_retries, "
+        "ucb_latency_p95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (datetime.fromtimestamp(start_time).isoformat(), time.time() - start_time, exitcode, socket.gethostname(),
+         settings.get('mode'), settings.get('platform'), settings.get('branch'), statistics.get('requests'),
+         statistics.get('retries'), statistics.get('latency_p95')))
+    runid = cursor.lastrowid
+
+    stages = METRICS.get('stages', dict())
+    for buildtargetid, artifact in METRICS.get('artifacts', dict()).items():
+        downloadrate = None
+        if artifact.get('size') and stages.get(buildtargetid, dict()).get('download'):
+            downloadrate = artifact['size'] / stages[buildtargetid]['download']
+        connection.execute(
+            "INSERT INTO artifacts (run_id, buildtargetid, build, version, sha256, size, extracted_size, download_rate) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (runid, buildtargetid, artifact.get('build'), artifact.get('version'), artifact.get('sha256'),
+             artifact.get('size'), artifact.get('extracted_size'), downloadrate))
+    for name, values in stages.items():
+        for stage, duration in values.items():
+            connection.execute("INSERT INTO stages (run_id, name, stage, duration) VALUES (?, ?, ?, ?)",
+                               (runid, name, stage, duration))
+    for upload in METRICS.get('uploads', dict()).values():
+        connection.execute(
+            "INSERT INTO uploads (run_id, name, store, build_id, new_bytes, reused_bytes, duration, upload_rate) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (runid, upload['name'], upload['store'], upload.get('build_id'), upload.get('new_bytes'),
+             upload.get('reused_bytes'), upload.get('duration'), upload.get('upload_rate')))
+    connection.commit()
+    return runid
+
+
+def get_history_series(connection, name):
+    # values of each metric of a build target (or package) from the oldest run to the latest
+    series = dict()
+    for size, extractedsize, downloadrate in connection.execute(
+            "SELECT size, extracted_size, download_rate FROM artifacts WHERE buildtargetid = ? ORDER BY run_id",
+            (name,)):
+        for metric, value in (('size', size), ('extracted_size', extractedsize), ('download_rate', downloadrate)):
+            if value is not None:
+                series.setdefault(metric, list()).append(value)
+    for stage, duration in connection.execute(
+            "SELECT stage, duration FROM stages WHERE name = ? ORDER BY run_id", (name,)):
+        series.setdefault(stage, list()).append(duration)
+    for store, newbytes, uploadrate in connection.execute(
+            "SELECT store, new_bytes, upload_rate FROM uploads WHERE name = ? ORDER BY run_id", (name,)):
+        for metric, value in ((f"{store}_new_bytes", newbytes), (f"{store}_upload_rate", uploadrate)):
+            if value is not None:
+                series.setdefault(metric, list()).append(value)
+    return series
+
+
+def find_regressions(series, window, ratio):
+    # compare the latest value of each metric with the median of the previous runs
+    regressions = list()
+    for metric, values in series.items():
+        previous = values[-window - 1:-1]
+        if len(previous) == 0:
+            continue
+        reference = percentile(previous, 0.5)
+        last = values[-1]
+        if metric.endswith('_rate'):
+            # a lower rate is worse
+            if last > 0 and reference / last >= ratio:
+                regressions.append((metric, last, reference))
+        elif reference > 0 and last / reference >= ratio:
+            regressions.append((metric, last, reference))
+    return regressions
+
+
+def format_history_value(metric, value):
+    if metric in ('size', 'extracted_size') or metric.endswith('_bytes'):
+        return f"{value / 1048576:.1f}MB"
+    if metric.endswith('_rate'):
+        return f"{value / 1048576:.1f}MB/s"
+    return f"{value:.1f}s"
+
+
+def log_regressions(connection, names):
+    window = int(get_config_value(['history', 'window'], 10))
+    ratio = float(get_config_value(['history', 'regression_ratio'], 1.5))
+    for name in names:
+        for metric, last, reference in find_regressions(get_history_series(connection, name), window, ratio):
+            log(f"Regression on {name} {metric}: {format_history_value(metric, last)} "
+                f"(median of the previous runs {format_history_value(metric, reference)})", logtype=LOG_WARNING)
+
+
+def save_run_history(exitcode):
+    # store the metrics of the run in the local history and sync it to S3, never failing the run
+    global CFG
+    settings = METRICS.get('run', dict()).get('settings', dict())
+    if not get_config_value(['history', 'enabled'], True) or settings.get('simulate', False):
+        return
+
+    path = get_config_value(['history', 'database'], CFG['basepath'] + '/UCB-steam.history.db')
+    client = s3_client()
+    for attempt in range(3):
+        try:
+            sync = True
+            try:
+                etag = history_download(client, CFG['aws']['s3bucket'], path)
+            except botocore_exceptions.ClientError as e:
+                log(f"The run history cannot be read from S3, only the local copy is updated: "
+                    f"{e.response['Error']['Message']}", logtype=LOG_WARNING)
+                sync = False
+
+            connection = history_connect(path)
+            try:
+                history_insert_run(connection, exitcode)
+                if attempt == 0:
+                    log_regressions(connection, sorted(set(METRICS.get('stages', dict()).keys()) | set(
+                        upload['name'] for upload in METRICS.get('uploads', dict()).values())))
+            finally:
+                connection.close()
+            if not sync:
+                return
+
+            # conditional write: a concurrent run saved meanwhile is not overwritten, the run is added to its copy
+            extraargs = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+            with open(path, "rb") as file:
+                client.put_object(Bucket=CFG['aws']['s3bucket'], Key=HISTORY_KEY, Body=file, **extraargs)
+            return
+        except botocore_exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                continue
+            log(f"The run history cannot be saved to S3: {e.response['Error']['Message']}", logtype=LOG_WARNING)
+            return
+        except (sqlite3.Error, OSError) as e:
+            log(f"The run history cannot be saved: {e}", logtype=LOG_WARNING)
+            return
+    log("The run history cannot be saved to S3: too many concurrent updates", logtype=LOG_WARNING)
+
+
+def print_history_statistics():
+    # --stats: percentiles and regressions of each build target from the run history
+    global CFG
+    path = get_config_value(['history', 'database'], CFG['basepath'] + '/UCB-steam.history.db')
+    try:
+        history_download(s3_client(), CFG['aws']['s3bucket'], path)
+    except botocore_exceptions.ClientError as e:
+        log(f"The run history cannot be read from S3, using the local copy: {e.response['Error']['Message']}",
+            logtype=LOG_WARNING)
+    if not os.path.exists(path):
+        log("No run history", logtype=LOG_ERROR)
+        return 14
+
+    connection = history_connect(path)
+    try:
+        durations = [row[0] for row in connection.execute("SELECT duration FROM runs ORDER BY id")]
+        failures = connection.execute("SELECT COUNT(*) FROM runs WHERE exitcode != 0").fetchone()[0]
+        if len(durations) > 0:
+            log(f"{len(durations)} runs ({failures} failed), duration p50 {percentile(durations, 0.5):.0f}s / "
+                f"p90 {percentile(durations, 0.9):.0f}s / max {max(durations):.0f}s")
+
+        names = [row[0] for row in connection.execute(
+            "SELECT buildtargetid FROM artifacts UNION SELECT name FROM stages UNION SELECT name FROM uploads "
+            "ORDER BY 1")]
+        for name in names:
+            log("--------------------------------------------------------------------------", nodate=True)
+            log(f"{name}:")
+            for metric, values in get_history_series(connection, name).items():
+                log(f" {metric}: {len(values)} runs, p50 {format_history_value(metric, percentile(values, 0.5))} / "
+                    f"p90 {format_history_value(metric, percentile(values, 0.9))} / "
+                    f"max {format_history_value(metric, max(values))}, last {format_history_value(metric, values[-1])}",
+                    nodate=True)
+        log("--------------------------------------------------------------------------", nodate=True)
+        log_regressions(connection, names)
+    finally:
+        connection.close()
+    return 0
+
+
+def get_steamcmd_bundle_roots():
+    # directories of the bundle, stored under these names in the archive and restored to the local paths
+    global CFG
+    roots = {'steamcmd': CFG['basepath'] + '/Steam/steamcmd'}
+    for index, path in enumerate(get_config_value(['steam', 'bundle', 'extra_paths'], [])):
+        roots[f"extra{index}"] = path
+    return roots
+
+
+def get_steamcmd_bundle_files():
+    # (name in the archive, path) of the regular files of the steamcmd directory and of its login state,
+    # without the logs changing at each run
+    exclude = get_config_value(['steam', 'bundle', 'exclude'], ['logs', 'dumps', 'appcache/httpcache'])
+    files = list()
+    for name, path in get_steamcmd_bundle_roots().items():
+        for root, dirs, filenames in os.walk(path):
+            relative = os.path.relpath(root, path)
+            dirs[:] = [directory for directory in dirs if
+                       os.path.normpath(os.path.join(relative, directory)) not in exclude]
+            for filename in filenames:
+                file = os.path.join(root, filename)
+                if os.path.isfile(file) and not os.path.islink(file):
+                    files.append((os.path.normpath(os.path.join(name, relative, filename)), file))
+    return sorted(files)
+
+
+def get_steamcmd_fingerprint(files):
+    # content of the files telling the steamcmd version and the login state only: steamcmd rewrites its other
+    # files (appcache, logs...) at each login, they would give a new bundle after every run
+    patterns = get_config_value(['steam', 'bundle', 'fingerprint'],
+                                ['steamcmd.sh', 'linux32/steamcmd', 'package/*.manifest', 'config.vdf', 'ssfn*'])
+    hasher = hashlib.sha256()
+    for name, file in files:
+        if match_patterns(name.partition('/')[2], patterns):
+            hasher.update(f"{name}\t{file_sha256(file)}\n".encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def extract_steamcmd_bundle(tar):
+    # only the regular files under a known root are restored, never outside of it: the archive comes from S3
+    roots = get_steamcmd_bundle_roots()
+    extracted = 0
+    for member in tar.getmembers():
+        name, _, relative = member.name.partition('/')
+        root = roots.get(name)
+        if root is None or not member.isfile() or relative == "" or os.path.isabs(relative):
+            continue
+        root = os.path.normpath(root)
+        destination = os.path.normpath(os.path.join(root, relative))
+        if not destination.startswith(root + os.sep):
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with tar.extractfile(member) as source, open(destination + '.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target, 1048576)
+        os.chmod(destination + '.tmp', member.mode & 0o755)
+        os.replace(destination + '.tmp', destination)
+        os.utime(destination, (member.mtime, member.mtime))
+        extracted += 1
+    return extracted
+
+
+def restore_steamcmd_bundle():
+    # restore the steamcmd bundle saved by the last instance, so steamcmd starts without self-updating or a full login
+    global CFG
+    if STEAMCMD_BUNDLE['checked'] or not get_config_value(['steam', 'bundle', 'enabled'], True):
+        return STEAMCMD_BUNDLE['version'] is not None
+    STEAMCMD_BUNDLE['checked'] = True
+
+    markerfile = CFG['basepath'] + '/Steam/steamcmd.bundle.json'
+    try:
+        manifest, etag = s3_get_json(CFG['aws']['s3bucket'], STEAMCMD_BUNDLE_PREFIX + 'current.json')
+    except botocore_exceptions.ClientError as e:
+        log(f"The steamcmd bundle cannot be read from S3: {e.response['Error']['Message']}", logtype=LOG_WARNING)
+        return False
+    if manifest is None:
+        return False
+
+    STEAMCMD_BUNDLE['etag'] = etag
+    # an unreadable marker (interrupted write) is the same as no bundle: it is restored again
+    markerversion = None
+    if os.path.exists(markerfile):
+        try:
+            markerversion = json.loads(read_from_file(markerfile)).get('version')
+        except (OSError, ValueError, AttributeError) as e:
+            log(f" The steamcmd bundle marker cannot be read: {e}", logtype=LOG_WARNING)
+    if markerversion == manifest['version']:
+        STEAMCMD_BUNDLE['version'] = manifest['version']
+        return True
+
+    log(f" Restoring the steamcmd bundle {manifest['version'][:12]}...", end="")
+    bundlefile = CFG['basepath'] + '/steamcmd-bundle.tar.gz'
+    ok = s3_download_file(manifest['key'], CFG['aws']['s3bucket'], bundlefile)
+    if ok != 0 or file_sha256(bundlefile) != manifest['sha256']:
+        log("The bundle cannot be downloaded, steamcmd will update itself", logtype=LOG_WARNING, nodate=True)
+        if os.path.exists(bundlefile):
+            os.remove(bundlefile)
+        return False
+    try:
+        with tarfile.open(bundlefile, "r:gz") as tar:
+            extracted = extract_steamcmd_bundle(tar)
+        if extracted == 0:
+            # bundle of an older format, replaced after this run
+            log("The bundle has no file to restore, steamcmd will update itself", logtype=LOG_WARNING, nodate=True)
+            return False
+    except (tarfile.TarError, OSError) as e:
+        log(f"The bundle cannot be extracted, steamcmd will update itself: {e}", logtype=LOG_WARNING, nodate=True)
+        return False
+    finally:
+        os.remove(bundlefile)
+    write_in_file(markerfile, json.dumps({'version': manifest['version']}))
+    STEAMCMD_BUNDLE['version'] = manifest['version']
+    log("OK", logtype=LOG_SUCCESS, nodate=True)
+    return True
+
+
+def save_steamcmd_bundle():
+    # snapshot steamcmd once it updated itself or refreshed its login state
+    global CFG
+    if not get_config_value(['steam', 'bundle', 'enabled'], True):
+        return
+
+    files = get_steamcmd_bundle_files()
+    version = get_steamcmd_fingerprint(files)
+    if len(files) == 0 or version == STEAMCMD_BUNDLE['version']:
+        return
+
+    log(f" Saving the steamcmd bundle {version[:12]}...", end="")
+    bundlefile = CFG['basepath'] + '/steamcmd-bundle.tar.gz'
+    try:
+        with tarfile.open(bundlefile, "w:gz") as tar:
+            for name, file in files:
+                tar.add(file, arcname=name, recursive=False)
+        key = f"{STEAMCMD_BUNDLE_PREFIX}steamcmd-{version}.tar.gz"
+        manifest = {'version': version, 'key': key, 'sha256': file_sha256(bundlefile),
+                    'host': socket.gethostname(), 'date': datetime.now().isoformat()}
+        ok = s3_upload_file(bundlefile, CFG['aws']['s3bucket'], key)
+        if ok != 0:
+            log("The bundle cannot be uploaded", logtype=LOG_WARNING, nodate=True)
+            return
+        # a bundle saved meanwhile by another instance is not replaced
+        if STEAMCMD_BUNDLE['etag'] is not None:
+            etag = s3_put_json(CFG['aws']['s3bucket'], STEAMCMD_BUNDLE_PREFIX + 'current.json', manifest,
+                               if_match=STEAMCMD_BUNDLE['etag'])
+        else:
+            etag = s3_put_json(CFG['aws']['s3bucket'], STEAMCMD_BUNDLE_PREFIX + 'current.json', manifest,
+                               if_none_match=True)
+    except (tarfile.TarError, OSError, botocore_exceptions.ClientError) as e:
+        log(f"The bundle cannot be saved: {e}", logtype=LOG_WARNING, nodate=True)
+        return
+    finally:
+        if os.path.exists(bundlefile):
+            os.remove(bundlefile)
+    if etag is None:
+        log("A newer bundle was saved by another instance", logtype=LOG_WARNING, nodate=True)
+        return
+
+    write_in_file(CFG['basepath'] + '/Steam/steamcmd.bundle.json', json.dumps({'version': version}))
+    STEAMCMD_BUNDLE.update({'checked': True, 'version': version, 'etag': etag})
+    log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+
+def s3_download_file_ranged(bucket_name, key, destination, size, part_size, threads):
+    # download an object with parallel ranged GETs written in place, return its SHA-256
+    # the parts are hashed in order as they arrive, at most 2 parts per thread are kept in memory
+    client = s3_client()
+    hasher = hashlib.sha256()
+    progress = TransferProgress(f"Download of {key} from S3", size, 'restore')
+    fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    # the connections of the bodies being read are shut down by the monitor when the download stalls
+    bodies = set()
+
+    def abort():
+        for body in list(bodies):
+            shutdown_response(getattr(body, '_raw_stream', body))
+
+    progress.on_abort(abort)
+
+    def fetch(start):
+        end = min(start + part_size, size) - 1
+        progress.check_abort()
+        response = client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end}")
+        bodies.add(response['Body'])
+        try:
+            data = response['Body'].read()
+        except Exception:
+            progress.check_abort()
+            raise
+        finally:
+            bodies.discard(response['Body'])
+        progress.check_abort()
+        if len(data) != end - start + 1:
+            raise OSError(f"{len(data)} bytes received for the range {start}-{end} of {key}")
+        os.pwrite(fd, data, start)
+        progress.update(len(data))
+        return data
+
+    try:
+        os.ftruncate(fd, size)
+        starts = list(range(0, size, part_size))
+        window = threads * 2
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(fetch, start) for start in starts[:window]]
+            for i in range(0, len(starts)):
+                hasher.update(futures[i].result())
+                futures[i] = None
+                if i + window < len(starts):
+                    futures.append(executor.submit(fetch, starts[i + window]))
+    finally:
+        os.close(fd)
+        progress.finish()
+    return hasher.hexdigest()
+
+
+def get_backup_builds(branch, platform=""):
+    # builds backed up to S3 by the previous runs, shaped like the UCB builds so they go through the normal stages
+    global CFG
+    client = s3_client()
+
+    def head(buildtargetid):
+        key = f"UCB/unity-builds/{branch}/ucb{buildtargetid}.zip"
+        try:
+            response = client.head_object(Bucket=CFG['aws']['s3bucket'], Key=key)
+        except botocore_exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        metadata = response.get('Metadata', dict())
+        return {'buildtargetid': buildtargetid, 'build': int(metadata.get('build', 0)), 'buildStatus': 'success',
+                'platform': metadata.get('platform', ""),
+                'finished': response['LastModified'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                'links': {'download_primary': {'href': f"s3://{CFG['aws']['s3bucket']}/{key}"}},
+                'backup': {'key': key, 'sha256': metadata.get('sha256'), 'size': response['ContentLength']}}
+
+    buildtargetids = list()
+    for buildtarget in CFG['buildtargets']:
+        buildtargetids.extend(buildtarget.keys())
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        backups = list(executor.map(head, buildtargetids))
+
+    builds = list()
+    for build in backups:
+        if build is None:
+            continue
+        if build['build'] == 0 or build['backup']['sha256'] is None:
+            log(f" The backup of {build['buildtargetid']} has no build number or checksum, "
+                f"it is downloaded whole or fetched again from UCB", logtype=LOG_WARNING)
+        if build['platform'] == platform or platform == "" or build['platform'] == "":
+            builds.append(build)
+    return builds
+
+
+def get_prefetched_backup(key, buildid):
+    # the artifact copied to the backup by the webhook handler as soon as the build finished, None if it is another build
+    global CFG
+    try:
+        response = s3_client().head_object(Bucket=CFG['aws']['s3bucket'], Key=key)
+    except botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    metadata = response.get('Metadata', dict())
+    if metadata.get('build') != str(buildid) or metadata.get('sha256') is None:
+        return None
+    return {'key': key, 'sha256': metadata['sha256'], 'size': response['ContentLength']}
+
+
+def file_sha256(file, chunk_size=1048576):
+    hasher = hashlib.sha256()
+    with open(file, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class FileDeduplicator:
+    # hardlink the files identical to a file already extracted in another build tree (the windows, linux and macos
+    # builds of a package share most of their data): candidates are found with the CRC and size stored in the zip
+    # then compared byte by byte, so a duplicate is never written to the disk
+    def __init__(self, min_size):
+        self.min_size = min_size
+        self.lock = threading.Lock()
+        self.files = dict()
+
+    def extract(self, zipObj, info, destination):
+        # return the size linked instead of written
+        targetpath = os.path.normpath(os.path.join(destination, info.filename))
+        if info.file_size < self.min_size or not targetpath.startswith(os.path.normpath(destination) + os.sep):
+            zipObj.extract(info, destination)
+            return 0
+
+        key = (info.CRC, info.file_size)
+        with self.lock:
+            candidates = list(self.files.get(key, list()))
+        for candidate in candidates:
+            if os.path.exists(candidate) and self.is_identical(zipObj, info, candidate):
+                os.makedirs(os.path.dirname(targetpath), exist_ok=True)
+                if os.path.exists(targetpath):
+                    os.remove(targetpath)
+                try:
+                    os.link(candidate, targetpath)
+                except OSError:
+                    # another filesystem or no hardlink support
+                    break
+                with self.lock:
+                    self.files[key].append(targetpath)
+                return info.file_size
+
+        targetpath = zipObj.extract(info, destination)
+        with self.lock:
+            self.files.setdefault(key, list()).append(targetpath)
+        return 0
+
+    def is_identical(self, zipObj, info, path, chunk_size=1048576):
+        if os.path.getsize(path) != info.file_size:
+            return False
+        with zipObj.open(info) as source, open(path, 'rb') as file:
+            while True:
+                chunk = source.read(chunk_size)
+                if chunk != file.read(len(chunk)):
+                    return False
+                if len(chunk) == 0:
+                    return True
+
+
+def get_deduplicator():
+    # None when disk.dedup is disabled
+    global DEDUPLICATOR
+    if not get_config_value(['disk', 'dedup'], False):
+        return None
+    with DEDUPLICATOR_LOCK:
+        if DEDUPLICATOR is None:
+            DEDUPLICATOR = FileDeduplicator(int(get_config_value(['disk', 'dedup_min_size'], 1048576)))
+        return DEDUPLICATOR
+
+
+def get_extract_exclusions(buildtargetid):
+    # file patterns never extracted: disk.exclude for all the build targets plus the exclude list of the build target
+    global CFG
+    exclusions = list(get_config_value(['disk', 'exclude'], list()))
+    for buildtarget in CFG['buildtargets']:
+        if buildtargetid in buildtarget and isinstance(buildtarget[buildtargetid], dict):
+            exclusions.extend(buildtarget[buildtargetid].get('exclude') or list())
+    return exclusions
+
+
+def match_patterns(filename, patterns):
+    # a pattern matches the path in the archive or only the file name (ex: *.pdb)
+    return any(fnmatch.fnmatch(filename, pattern) or fnmatch.fnmatch(os.path.basename(filename), pattern)
+               for pattern in patterns)
+
+
+def extract_zip(zipObj, destination, versionfilename="UCB_version.txt", deduplicator=None, exclusions=None,
+                symbols=None, symbolpatterns=None):
+    # extract the archive, the version files are read from the archive instead of being extracted
+    # the excluded files are skipped, the excluded symbol files are streamed to the symbols archive when given
+    # return the versions read, the size hardlinked by the deduplicator and the size excluded
+    versions = list()
+    linkedsize = 0
+    excludedsize = 0
+    for info in zipObj.infolist():
+        if not info.is_dir() and os.path.basename(info.filename) == versionfilename:
+            versions.append(zipObj.read(info).decode('utf-8').rstrip('\n'))
+        elif exclusions and not info.is_dir() and match_patterns(info.filename, exclusions):
+            excludedsize += info.file_size
+            if symbols is not None and match_patterns(info.filename, symbolpatterns or list()):
+                with zipObj.open(info) as source, symbols.open(info.filename, 'w', force_zip64=True) as target:
+                    shutil.copyfileobj(source, target, 1048576)
+        elif deduplicator is not None and not info.is_dir():
+            linkedsize += deduplicator.extract(zipObj, info, destination)
+        else:
+            zipObj.extract(info, destination)
+
+    if len(versions) > 1:
+        log(f"{len(versions)} files {versionfilename} found in the archive, the version is ignored",
+            logtype=LOG_WARNING, nodate=True)
+
+    return versions, linkedsize, excludedsize
+
+
+class TransferStalledError(OSError):
+    pass
+
+
+class TransferProgress:
+    # telemetry of a transfer: every telemetry.interval seconds the bytes done, current and average rate and ETA are
+    # logged; a rate under telemetry.stall_rate (MB/s) during telemetry.stall_time seconds is reported as a stall
+    # and aborts the transfer when telemetry.stall_abort is set: the monitor calls the abort callbacks registered by the
+    # transfer (closing its connection or cancelling it) so a transfer that receives nothing is interrupted too
+    def __init__(self, name, total=None, bandwidthclass=None):
+        self.name = name
+        self.total = total
+        self.governor = get_governor() if bandwidthclass is not None else None
+        self.bandwidthclass = bandwidthclass
+        self.interval = get_config_value(['telemetry', 'interval'], 30)
+        self.stall_rate = get_config_value(['telemetry', 'stall_rate'], 0) * 1048576
+        self.stall_time = get_config_value(['telemetry', 'stall_time'], 120)
+        self.stall_abort = get_config_value(['telemetry', 'stall_abort'], False)
+        self.lock = threading.Lock()
+        self.done = 0
+        self.start = time.time()
+        self.lastcheck = self.start
+        self.lastdone = 0
+        self.slowsince = None
+        self.stalled = False
+        self.aborted = False
+        self.aborts = list()
+        with TRANSFERS_LOCK:
+            TRANSFERS.append(self)
+        start_transfers_monitor()
+
+    def on_abort(self, callback):
+        self.aborts.append(callback)
+
+    def abort_message(self):
+        return f"{self.name} stalled under {self.stall_rate / 1048576:.2f}MB/s for {self.stall_time}s"
+
+    def check_abort(self):
+        if self.aborted:
+            raise TransferStalledError(self.abort_message())
+
+    def update(self, count):
+        # also used as boto3 transfer callback
+        self.check_abort()
+        with self.lock:
+            self.done += count
+        if self.governor is not None:
+            self.governor.consume(self.bandwidthclass, count)
+
+    def check(self, now):
+        with self.lock:
+            if now - self.lastcheck < self.interval:
+                return
+            rate = (self.done - self.lastdone) / (now - self.lastcheck)
+            average = self.done / (now - self.start)
+            self.lastcheck = now
+            self.lastdone = self.done
+            done = self.done
+
+        progress = f"{done / 1048576:.0f}MB"
+        if self.total:
+            progress += f"/{self.total / 1048576:.0f}MB ({done * 100 / self.total:.0f}%)"
+        progress += f", {rate / 1048576:.1f}MB/s now, {average / 1048576:.1f}MB/s average"
+        if self.total and average > 0:
+            progress += f", ETA {(self.total - done) / average:.0f}s"
+        log(f" {self.name}: {progress}")
+
+        if rate >= self.stall_rate:
+            self.slowsince = None
+            return
+        if self.slowsince is None:
+            self.slowsince = now - self.interval
+        if now - self.slowsince >= self.stall_time and not self.stalled:
+            self.stalled = True
+            log(f" {self.name} is stalled: under {self.stall_rate / 1048576:.2f}MB/s for {now - self.slowsince:.0f}s"
+                + (", aborting" if self.stall_abort else ""), logtype=LOG_WARNING)
+            if self.stall_abort:
+                self.aborted = True
+                for callback in self.aborts:
+                    try:
+                        callback()
+                    except Exception as e:
+                        log(f" Aborting {self.name} failed: {e}", logtype=LOG_WARNING)
+
+    def finish(self):
+        with TRANSFERS_LOCK:
+            if self in TRANSFERS:
+                TRANSFERS.remove(self)
+        duration = time.time() - self.start
+        if duration >= self.interval:
+            log(f" {self.name}: {self.done / 1048576:.0f}MB in {duration:.0f}s "
+                f"({self.done / 1048576 / duration:.1f}MB/s)")
+
+
+def monitor_transfers():
+    while True:
+        time.sleep(1)
+        with TRANSFERS_LOCK:
+            transfers = list(TRANSFERS)
+        for transfer in transfers:
+            transfer.check(time.time())
+
+
+def start_transfers_monitor():
+    global TRANSFERS_MONITOR
+    with TRANSFERS_LOCK:
+        if TRANSFERS_MONITOR is None:
+            TRANSFERS_MONITOR = threading.Thread(target=monitor_transfers, daemon=True)
+            TRANSFERS_MONITOR.start()
+
+
+class BandwidthGovernor:
+    # token buckets (bytes/s, 0 for unlimited) for all the transfers and for each class of transfer
+    # a transfer waiting for the shared bucket lets the waiting transfers of a higher priority class go first, and
+    # the shared rate is lowered by the reserve while steamcmd or butler upload from their own process
+    def __init__(self, limit, reserve, classes):
+        self.limit = limit
+        self.reserve = reserve
+        self.external = 0
+        self.classes = classes
+        self.condition = threading.Condition()
+        self.waiting = dict()
+        now = time.time()
+        self.buckets = {name: {'tokens': 0.0, 'last': now} for name in list(classes.keys()) + [None]}
+
+    def rate(self, name):
+        if name is not None:
+            return self.classes.get(name, dict()).get('limit', 0)
+        if self.limit > 0 and self.external > 0:
+            return max(self.limit - self.reserve, self.limit * 0.1)
+        return self.limit
+
+    def refill(self, name, now):
+        # at most one second of burst is kept; the tokens can go negative, the next transfer then waits
+        bucket = self.buckets.setdefault(name, {'tokens': 0.0, 'last': now})
+        rate = self.rate(name)
+        if rate > 0:
+            bucket['tokens'] = min(float(rate), bucket['tokens'] + (now - bucket['last']) * rate)
+        bucket['last'] = now
+        return bucket, rate
+
+    def consume(self, name, count):
+        priority = self.classes.get(name, dict()).get('priority', 0)
+        with self.condition:
+            self.waiting[priority] = self.waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    now = time.time()
+                    shared, rate = self.refill(None, now)
+                    first = not any(self.waiting[other] > 0 for other in self.waiting if other > priority)
+                    if rate == 0 or (first and shared['tokens'] >= 0):
+                        break
+                    self.condition.wait(max(-shared['tokens'] / rate, 0.05) if first else 0.05)
+                if rate > 0:
+                    shared['tokens'] -= count
+                classbucket, classrate = self.refill(name, now)
+                if classrate > 0:
+                    classbucket['tokens'] -= count
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+        # the class limit is applied out of the lock so the other classes are not blocked
+        if classrate > 0 and classbucket['tokens'] < 0:
+            time.sleep(-classbucket['tokens'] / classrate)
+
+    @contextlib.contextmanager
+    def reserved(self):
+        # steamcmd and butler are not throttled here: the in-process transfers leave them the reserve
+        with self.condition:
+            self.external += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.external -= 1
+                self.condition.notify_all()
+
+
+def get_governor():
+    # None when no bandwidth limit is configured
+    global GOVERNOR
+    limit = get_config_value(['bandwidth', 'limit'], 0) * 1048576
+    classes = dict()
+    for name, values in get_config_value(['bandwidth', 'classes'], dict()).items():
+        values = values or dict()
+        classes[name] = {'limit': (values.get('limit') or 0) * 1048576, 'priority': values.get('priority') or 0}
+    if limit == 0 and all(values['limit'] == 0 for values in classes.values()):
+        return None
+    with GOVERNOR_LOCK:
+        if GOVERNOR is None:
+            GOVERNOR = BandwidthGovernor(limit, get_config_value(['bandwidth', 'steam_reserve'], 0) * 1048576,
+                                         classes)
+        return GOVERNOR
+
+
+def reserve_bandwidth():
+    governor = get_governor()
+    return governor.reserved() if governor is not None else contextlib.nullcontext()
+
+
+def shutdown_response(raw):
+    # closing a response does not wake up a thread blocked reading it, shutting its socket down does
+    sock = getattr(getattr(raw, 'connection', None), 'sock', None)
+    if sock is not None:
+        sock.shutdown(socket.SHUT_RDWR)
+    else:
+        raw.close()
+
+
+def download_file(url, destination, chunk_size=1048576, upload=None):
+    # stream the file to the disk and compute its SHA-256 and size on the way
+    # when an S3StreamUpload is given, the same bytes are sent to S3 at the same time
+    hasher = hashlib.sha256()
+    size = 0
+    timeout = (get_config_value(['unity', 'http', 'connect_timeout'], 10),
+               get_config_value(['unity', 'http', 'read_timeout'], 60))
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        total = response.headers.get('Content-Length')
+        progress = TransferProgress(f"Download of {os.path.basename(destination)}",
+                                    int(total) if total is not None else None, 'download')
+        progress.on_abort(lambda: shutdown_response(response.raw))
+        try:
+            with open(destination, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    if upload is not None:
+                        upload.write(chunk)
+                    progress.update(len(chunk))
+            progress.check_abort()
+        except Exception:
+            progress.check_abort()
+            raise
+        finally:
+            progress.finish()
+
+    return hasher.hexdigest(), size
+
+
 def log(message, end="\r\n", nodate=False, logtype=LOG_INFO):
     global DEBUG_FILE
 
@@ -372,29 +2036,1790 @@ def log(message, end="\r\n", nodate=False, logtype=LOG_INFO):
         strprint = strprint + f"{Fore.GREEN}"
         strfile = strfile + "<font color='green'>"
 
-    strprint = strprint + message
-    strfile = strfile + message
+    strprint = strprint + message
+    strfile = strfile + message
+
+    if logtype == LOG_ERROR or logtype == LOG_WARNING or logtype == LOG_SUCCESS:
+        strprint = strprint + f"{Style.RESET_ALL}"
+        strfile = strfile + "</font>"
+
+    prefix = getattr(LOG_CONTEXT, 'prefix', None)
+    if prefix is not None:
+        # the line is only written once complete
+        LOG_CONTEXT.pending.append((strprint, strfile))
+        if end == "":
+            return
+        strprint = f"[{prefix}] " + "".join(pendingprint for pendingprint, pendingfile in LOG_CONTEXT.pending)
+        strfile = f"[{prefix}] " + "".join(pendingfile for pendingprint, pendingfile in LOG_CONTEXT.pending)
+        LOG_CONTEXT.pending = list()
+
+    with LOG_LOCK:
+        if end == "":
+            print(strprint, end="")
+        else:
+            print(strprint)
+        if not DEBUG_FILE.closed:
+            if end == "":
+                DEBUG_FILE.write(strfile)
+                DEBUG_FILE.flush()
+            else:
+                DEBUG_FILE.write(strfile + '</br>' + end)
+                DEBUG_FILE.flush()
+
+
+def trigger_builds(branch="", gitbranch="", simulate=False):
+    # start a build of every configured build target (optionally only the ones of a branch) concurrently
+    # when a git branch is given, the build targets are cloned to build this branch and deleted at the end
+    user = get_config_value(['unity', 'trigger', 'user'], 'UCB-steam')
+    threads = max(1, int(get_config_value(['unity', 'trigger', 'threads'], 8)))
+    poll_interval = get_config_value(['unity', 'trigger', 'poll_interval'], 60)
+    timeout = get_config_value(['unity', 'trigger', 'timeout'], 180)
+    cancel_on_timeout = get_config_value(['unity', 'trigger', 'cancel_on_timeout'], False)
+    returncode = 0
+
+    buildtargetids = list()
+    for buildtarget in CFG['buildtargets']:
+        for buildtargetid in buildtarget.keys():
+            # the branch name is at the beginning of the build target name (ex: beta-windows-64bit)
+            if branch == "" or buildtargetid.split("-")[0] == branch:
+                buildtargetids.append(buildtargetid)
+
+    if len(buildtargetids) == 0:
+        log("No build target configured for this branch", logtype=LOG_ERROR)
+        return 50
+
+    log("--------------------------------------------------------------------------", nodate=True)
+    log(f"Triggering builds for {len(buildtargetids)} build targets...")
+
+    # key: build target that is built, value: configured build target
+    triggeredtargets = dict()
+    clones = list()
+    if gitbranch != "":
+        log(f" Cloning build targets for git branch {gitbranch}...", end="")
+        if not simulate:
+            with ThreadPoolExecutor(max_workers=min(threads, len(buildtargetids))) as executor:
+                clonedids = list(executor.map(lambda item: clone_build_target(item, gitbranch, user), buildtargetids))
+        else:
+            clonedids = [f"{buildtargetid}-{gitbranch}" for buildtargetid in buildtargetids]
+
+        for buildtargetid, clonedid in zip(buildtargetids, clonedids):
+            if clonedid is None:
+                returncode = 51
+            else:
+                clones.append(clonedid)
+                triggeredtargets[clonedid] = buildtargetid
+
+        if returncode != 0:
+            log(f"{len(buildtargetids) - len(clones)} build targets were not cloned", logtype=LOG_ERROR, nodate=True)
+        else:
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+    else:
+        for buildtargetid in buildtargetids:
+            triggeredtargets[buildtargetid] = buildtargetid
+
+    pendingbuilds = dict()
+    if len(triggeredtargets) > 0:
+        log(" Starting builds...", end="")
+        if not simulate:
+            with ThreadPoolExecutor(max_workers=min(threads, len(triggeredtargets))) as executor:
+                buildnumbers = list(executor.map(start_build, triggeredtargets.keys()))
+        else:
+            buildnumbers = [0] * len(triggeredtargets)
+
+        for buildtargetid, buildnumber in zip(triggeredtargets.keys(), buildnumbers):
+            if buildnumber is None:
+                returncode = 52
+            else:
+                pendingbuilds[buildtargetid] = buildnumber
+
+        if len(pendingbuilds) != len(triggeredtargets):
+            log(f"{len(triggeredtargets) - len(pendingbuilds)} builds were not started", logtype=LOG_ERROR,
+                nodate=True)
+        else:
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+        for buildtargetid, buildnumber in pendingbuilds.items():
+            log(f"  Build #{buildnumber} started for {buildtargetid}")
+
+    # poll UCB until every build is finished
+    # the security shutdown of the startup script (30 minutes after the boot) ends a longer wait
+    results = dict()
+    if not simulate:
+        if len(pendingbuilds) > 0:
+            log(f" Waiting up to {timeout} minutes for the builds...")
+        deadline = time.time() + timeout * 60
+        while len(pendingbuilds) > 0 and time.time() < deadline:
+            time.sleep(poll_interval)
+            items = list(pendingbuilds.items())
+            with ThreadPoolExecutor(max_workers=min(threads, len(items))) as executor:
+                statuses = list(executor.map(lambda item: get_build(item[0], item[1]), items))
+
+            for (buildtargetid, buildnumber), build in zip(items, statuses):
+                if build is None or build.get('buildStatus') in BUILD_STATUS_BUILDING:
+                    continue
+                results[buildtargetid] = build['buildStatus']
+                del pendingbuilds[buildtargetid]
+                if build['buildStatus'] == 'success':
+                    log(f"  Build #{buildnumber} for {buildtargetid} succeeded", logtype=LOG_SUCCESS)
+                else:
+                    log(f"  Build #{buildnumber} for {buildtargetid} ended with status {build['buildStatus']}",
+                        logtype=LOG_ERROR)
+                    returncode = 53
+
+        if len(pendingbuilds) > 0:
+            log(f" {len(pendingbuilds)} builds are still running after {timeout} minutes", logtype=LOG_ERROR)
+            returncode = 54
+            if cancel_on_timeout:
+                log(f" Cancelling {len(pendingbuilds)} builds...")
+                items = list(pendingbuilds.items())
+                with ThreadPoolExecutor(max_workers=min(threads, len(items))) as executor:
+                    cancelled = list(executor.map(lambda item: cancel_build(item[0], item[1]), items))
+                for (buildtargetid, buildnumber), ok in zip(items, cancelled):
+                    if ok:
+                        log(f"  Build #{buildnumber} for {buildtargetid} cancelled", logtype=LOG_WARNING)
+                        del pendingbuilds[buildtargetid]
+    else:
+        for buildtargetid in pendingbuilds.keys():
+            results[buildtargetid] = 'success'
+
+    # deleting a clone kills its build: the clones still building are left in place
+    running = [clonedid for clonedid in clones if clonedid in pendingbuilds]
+    if len(running) > 0:
+        log(f" {len(running)} cloned build targets are kept while they are building: {', '.join(running)}. "
+            f"Delete them once their builds are finished", logtype=LOG_WARNING)
+        clones = [clonedid for clonedid in clones if clonedid not in pendingbuilds]
+
+    if len(clones) > 0:
+        log(f" Deleting {len(clones)} cloned build targets...", end="")
+        if not simulate:
+            with ThreadPoolExecutor(max_workers=min(threads, len(clones))) as executor:
+                deleted = list(executor.map(delete_build_target, clones))
+        else:
+            deleted = [True] * len(clones)
+
+        if not all(deleted):
+            log(f"{deleted.count(False)} cloned build targets were not deleted", logtype=LOG_ERROR, nodate=True)
+        else:
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    log(f" {list(results.values()).count('success')}/{len(triggeredtargets)} builds succeeded")
+    return returncode
+
+
+def print_help():
+    print(
+        f"UCB-steam.py --platform=(standalonelinux64, standaloneosxuniversal, standalonewindows64) [--branch=(prod, beta, develop)] [--nolive] [--force] [--version=<version>] [--install] [--nodownload] [--noupload] [--noclean] [--noshutdown] [--noemail] [--steamuser=<steamuser>] [--steampassword=<steampassword>] [--wait] [--noresume] [--profilestartup] [--profile]")
+    print(
+        f"UCB-steam.py --trigger [--branch=(prod, beta, develop)] [--gitbranch=<git branch>] [--simulate] [--noshutdown] [--noemail]")
+    print(
+        f"UCB-steam.py --from-backup --branch=(prod, beta, develop) [--platform=<platform>] [--nolive] [--version=<version>] [--noupload] [--simulate] [--noshutdown] [--noemail]")
+    print(f"UCB-steam.py --stats")
+    print(
+        f"UCB-steam.py (--enqueue | --worker) [--platform=<platform>] [--branch=(prod, beta, develop)] [--simulate] [--noshutdown] [--noemail]")
+
+
+def classify_builds(allbuilds):
+    # sort the builds by status
+    builds = dict()
+    builds['success'] = list()
+    builds['building'] = list()
+    builds['failure'] = list()
+    builds['canceled'] = list()
+    builds['unknown'] = list()
+
+    for build in allbuilds:
+        if build['buildStatus'] == 'success':
+            builds['success'].append(build)
+        elif build['buildStatus'] in BUILD_STATUS_BUILDING:
+            builds['building'].append(build)
+        elif build['buildStatus'] == 'failure':
+            builds['failure'].append(build)
+        elif build['buildStatus'] == 'canceled':
+            builds['canceled'].append(build)
+        else:
+            builds['unknown'].append(build)
+
+    return builds
+
+
+def get_packages(allbuilds, platform="", skipdeployed=True):
+    global CFG
+
+    packagecomplete = dict()
+
+    # build package structure for consistency check
+    # region STEAM
+    steampackages = dict()
+    for buildtarget in CFG['buildtargets']:
+        for buildtargetid in buildtarget.keys():
+            if 'steam' in buildtarget[buildtargetid]:
+                if 'package' in buildtarget[buildtargetid]['steam']:
+                    package = buildtarget[buildtargetid]['steam']['package']
+                    if package not in steampackages:
+                        steampackages[package] = dict()
+
+                    steampackages[package][buildtargetid] = dict()
+                    steampackages[package][buildtargetid]['complete'] = False
+
+    for build in allbuilds:
+        if build['platform'] == platform or platform == "":
+            buildtargetid = build['buildtargetid']
+            for buildtarget in CFG['buildtargets']:
+                if buildtargetid in buildtarget.keys():
+                    if 'steam' in buildtarget[buildtargetid]:
+                        if 'package' in buildtarget[buildtargetid]['steam']:
+                            package = buildtarget[buildtargetid]['steam']['package']
+
+                            if build['buildStatus'] == 'success':
+                                steampackages[package][buildtargetid]['complete'] = True
+
+                            if 'builds' not in steampackages[package][buildtargetid]:
+                                steampackages[package][buildtargetid]['builds'] = list()
+                            steampackages[package][buildtargetid]['builds'].append(build)
+
+    # identify the full completion of a package (based on the configuration)
+    for package in steampackages.keys():
+        if package not in packagecomplete.keys():
+            packagecomplete[package] = dict()
+            packagecomplete[package]['complete'] = True
+            packagecomplete[package]['builds'] = list()
+
+        packagecomplete[package]['steam'] = True
+
+        for buildtargetid, buildtargetvalue in steampackages[package].items():
+            if 'builds' in buildtargetvalue:
+                for build in buildtargetvalue['builds']:
+                    if build not in packagecomplete[package]['builds'] and build['buildStatus'] == 'success':
+                        packagecomplete[package]['builds'].append(build)
+
+            if not buildtargetvalue['complete']:
+                packagecomplete[package]['steam'] = False
+                packagecomplete[package]['complete'] = False
+    # endregion
+
+    # region BUTLER
+    butlerpackages = dict()
+    for buildtarget in CFG['buildtargets']:
+        for buildtargetid in buildtarget.keys():
+            if 'butler' in buildtarget[buildtargetid]:
+                if 'package' in buildtarget[buildtargetid]['butler']:
+                    package = buildtarget[buildtargetid]['butler']['package']
+                    if package not in butlerpackages:
+                        butlerpackages[package] = dict()
+
+                    butlerpackages[package][buildtargetid] = dict()
+                    butlerpackages[package][buildtargetid]['complete'] = False
+
+    for build in allbuilds:
+        if build['platform'] == platform or platform == "":
+            buildtargetid = build['buildtargetid']
+            for buildtarget in CFG['buildtargets']:
+                if buildtargetid in buildtarget.keys():
+                    if 'butler' in buildtarget[buildtargetid]:
+                        if 'package' in buildtarget[buildtargetid]['butler']:
+                            package = buildtarget[buildtargetid]['butler']['package']
+
+                            if build['buildStatus'] == 'success':
+                                butlerpackages[package][buildtargetid]['complete'] = True
+
+                            if 'builds' not in butlerpackages[package][buildtargetid]:
+                                butlerpackages[package][buildtargetid]['builds'] = list()
+                            butlerpackages[package][buildtargetid]['builds'].append(build)
+
+    # identify the full completion of a package (based on the configuration)
+    for package in butlerpackages.keys():
+        if package not in packagecomplete.keys():
+            packagecomplete[package] = dict()
+            packagecomplete[package]['complete'] = True
+            packagecomplete[package]['builds'] = list()
+
+        packagecomplete[package]['butler'] = True
+
+        for buildtargetid, buildtargetvalue in butlerpackages[package].items():
+            if 'builds' in buildtargetvalue:
+                for build in buildtargetvalue['builds']:
+                    if build not in packagecomplete[package]['builds'] and build['buildStatus'] == 'success':
+                        packagecomplete[package]['builds'].append(build)
+
+            if not buildtargetvalue['complete']:
+                packagecomplete[package]['butler'] = False
+                packagecomplete[package]['complete'] = False
+
+    # endregion
+
+    # the successful builds kept in UCB (unity.cleanup.keep_success_count) are not deployed: only the last build of
+    # each build target is, and only once
+    for package, packagevalue in packagecomplete.items():
+        buildnumbers = get_package_buildnumbers(packagevalue)
+        packagevalue['builds'] = [build for build in packagevalue['builds']
+                                  if build['build'] == buildnumbers[build['buildtargetid']]]
+        if skipdeployed and packagevalue['complete'] and get_journal().is_deployed(package, buildnumbers):
+            log(f" Package {package} was already deployed with these builds")
+            packagevalue['complete'] = False
+
+    return steampackages, butlerpackages, packagecomplete
+
+
+def filter_packages(packages, steampackages, butlerpackages, packagecomplete):
+    # keep only the given packages in the package structures
+    return {package: value for package, value in steampackages.items() if package in packages}, \
+           {package: value for package, value in butlerpackages.items() if package in packages}, \
+           {package: value for package, value in packagecomplete.items() if package in packages}
+
+
+def get_build_duration(build):
+    if build.get('totalTimeInSeconds'):
+        return float(build['totalTimeInSeconds'])
+
+    createddate = parse_ucb_date(build.get('created'))
+    finisheddate = parse_ucb_date(build.get('finished'))
+    if createddate is None or finisheddate is None:
+        return None
+    return (finisheddate - createddate).total_seconds()
+
+
+def get_expected_durations(allbuilds, history=5):
+    # average duration of the last successful builds of each build target
+    durations = dict()
+    for build in sorted(allbuilds, key=lambda item: int(item['build']), reverse=True):
+        if build['buildStatus'] != 'success':
+            continue
+        duration = get_build_duration(build)
+        if duration is None:
+            continue
+        if build['buildtargetid'] not in durations:
+            durations[build['buildtargetid']] = list()
+        if len(durations[build['buildtargetid']]) < history:
+            durations[build['buildtargetid']].append(duration)
+
+    return {buildtargetid: sum(values) / len(values) for buildtargetid, values in durations.items()}
+
+
+def get_next_poll(build, durations, default_duration, min_poll, max_poll):
+    # poll a build around its expected end (based on the history of its build target), then every min_poll seconds
+    expected = durations.get(build['buildtargetid'], default_duration)
+    createddate = parse_ucb_date(build.get('created'))
+    if createddate is None:
+        remaining = expected
+    else:
+        remaining = expected - (datetime.utcnow() - createddate).total_seconds()
+
+    return time.time() + min(max_poll, max(min_poll, remaining))
+
+
+def wait_for_packages(allbuilds, processed, settings):
+    # watch the builds in progress and process every package as soon as it becomes complete
+    min_poll = get_config_value(['unity', 'wait', 'min_poll'], 30)
+    max_poll = get_config_value(['unity', 'wait', 'max_poll'], 300)
+    max_wait = get_config_value(['unity', 'wait', 'max_wait'], 25)
+    default_duration = get_config_value(['unity', 'wait', 'default_duration'], 1800)
+    platform = settings['platform']
+
+    durations = get_expected_durations(allbuilds)
+    deadline = time.time() + max_wait * 60
+
+    steampackages, butlerpackages, packagecomplete = get_packages(allbuilds, platform)
+    waitingtargets = set()
+    for package in packagecomplete.keys():
+        if package not in processed:
+            waitingtargets.update(steampackages.get(package, dict()).keys())
+            waitingtargets.update(butlerpackages.get(package, dict()).keys())
+
+    # key: (buildtargetid, build), value: time of the next poll
+    watched = dict()
+    for build in allbuilds:
+        if build['buildStatus'] in BUILD_STATUS_BUILDING and build['buildtargetid'] in waitingtargets and (
+                build['platform'] == platform or platform == ""):
+            watched[(build['buildtargetid'], build['build'])] = get_next_poll(build, durations, default_duration,
+                                                                              min_poll, max_poll)
+
+    if len(watched) == 0:
+        return 0
+
+    log("--------------------------------------------------------------------------", nodate=True)
+    log(f"Waiting for {len(watched)} builds in progress (max {max_wait} minutes)...")
+
+    while len(watched) > 0 and time.time() < deadline:
+        time.sleep(max(0, min(min(watched.values()), deadline) - time.time()))
+
+        due = [key for key, nextpoll in watched.items() if nextpoll <= time.time()]
+        if len(due) == 0:
+            continue
+        with ThreadPoolExecutor(max_workers=min(8, len(due))) as executor:
+            polledbuilds = list(executor.map(lambda key: get_build(key[0], key[1]), due))
+
+        changed = False
+        for key, polledbuild in zip(due, polledbuilds):
+            if polledbuild is None:
+                watched[key] = time.time() + min_poll
+                continue
+            if polledbuild['buildStatus'] in BUILD_STATUS_BUILDING:
+                watched[key] = get_next_poll(polledbuild, durations, default_duration, min_poll, max_poll)
+                continue
+
+            del watched[key]
+            for i in range(0, len(allbuilds)):
+                if allbuilds[i]['buildtargetid'] == key[0] and allbuilds[i]['build'] == key[1]:
+                    allbuilds[i] = polledbuild
+            changed = True
+
+            if polledbuild['buildStatus'] == 'success':
+                log(f" Build #{key[1]} for {key[0]} succeeded", logtype=LOG_SUCCESS)
+            else:
+                log(f" Build #{key[1]} for {key[0]} ended with status {polledbuild['buildStatus']}",
+                    logtype=LOG_WARNING)
+
+        if not changed:
+            continue
+
+        steampackages, butlerpackages, packagecomplete = get_packages(allbuilds, platform)
+        newpackages = list()
+        for package, packagevalue in packagecomplete.items():
+            if packagevalue['complete'] and package not in processed:
+                newpackages.append(package)
+
+        if len(newpackages) > 0:
+            log(f" Package(s) {', '.join(newpackages)} complete, processing...", logtype=LOG_SUCCESS)
+            processed.extend(newpackages)
+            returncode = deploy_packages(newpackages, steampackages, butlerpackages, packagecomplete,
+                                         classify_builds(allbuilds), settings)
+            if returncode != 0:
+                return returncode
+
+    if len(watched) > 0:
+        log(f" {len(watched)} builds are still in progress after {max_wait} minutes", logtype=LOG_WARNING)
+
+    return 0
+
+
+def get_artifact_size(build):
+    # size of the zip announced by UCB
+    try:
+        return int(build['links']['download_primary']['meta']['fileSize'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def estimate_package_disk_usage(packagevalue, platform, extract_ratio):
+    # peak usage while processing a package: all its extracted builds plus the biggest zip being extracted
+    sizes = dict()
+    unknown = False
+    for build in packagevalue['builds']:
+        if build['platform'] == platform or platform == "":
+            size = get_artifact_size(build)
+            if size is None:
+                unknown = True
+            else:
+                sizes[build['buildtargetid']] = max(size, sizes.get(build['buildtargetid'], 0))
+
+    if len(sizes) == 0:
+        return 0, unknown
+    return int(sum(sizes.values()) * extract_ratio + max(sizes.values())), unknown
+
+
+def deploy_packages(packages, steampackages, butlerpackages, packagecomplete, builds, settings):
+    # process the given packages, one at a time within the disk budget if one is configured
+    budget = get_config_value(['disk', 'budget'], 0) * 1073741824
+    if budget <= 0:
+        return process_packages(*filter_packages(packages, steampackages, butlerpackages, packagecomplete), builds,
+                                settings)
+
+    extract_ratio = get_config_value(['disk', 'extract_ratio'], 2.5)
+    cleanbuildtree = get_config_value(['disk', 'clean_build_tree'], True) and not settings['noupload'] and not \
+        settings['nodownload'] and not settings['simulate']
+    buildpath = CFG['basepath'] + '/Steam/build'
+
+    estimates = dict()
+    for package in packages:
+        estimates[package], unknown = estimate_package_disk_usage(packagecomplete[package], settings['platform'],
+                                                                  extract_ratio)
+        if unknown:
+            log(f"The size of some builds of package {package} is unknown, the disk budget may be exceeded",
+                logtype=LOG_WARNING)
+
+    used = 0
+    remaining = list(packages)
+    while len(remaining) > 0:
+        available = min(budget - used, shutil.disk_usage(CFG['basepath']).free)
+        candidates = [package for package in remaining if estimates[package] <= available]
+        if len(candidates) == 0:
+            for package in remaining:
+                log(f"Package {package} needs {estimates[package] / 1073741824:.2f}GB but only "
+                    f"{available / 1073741824:.2f}GB are available in the disk budget", logtype=LOG_ERROR)
+            return 13
+
+        # smallest package first: the most packages fit when the extracted builds are kept
+        package = min(candidates, key=lambda item: estimates[item])
+        remaining.remove(package)
+        log("--------------------------------------------------------------------------", nodate=True)
+        log(f"Processing package {package} (estimated {estimates[package] / 1073741824:.2f}GB, "
+            f"{available / 1073741824:.2f}GB available)...")
+
+        returncode = process_packages(*filter_packages([package], steampackages, butlerpackages, packagecomplete),
+                                      builds, settings)
+        if returncode != 0:
+            return returncode
+
+        if cleanbuildtree:
+            log(f" Deleting the extracted builds of package {package}...", end="")
+            for buildtargetid in set(steampackages.get(package, dict()).keys()) | set(
+                    butlerpackages.get(package, dict()).keys()):
+                if os.path.exists(f"{buildpath}/{buildtargetid}"):
+                    shutil.rmtree(f"{buildpath}/{buildtargetid}", ignore_errors=True)
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+        else:
+            used += estimates[package]
+
+    return 0
+
+
+def download_build(build, settings):
+    # download a build from UCB, extract it then back it up to S3
+    global CFG
+
+    force = settings['force']
+    simulate = settings['simulate']
+    buildpath = CFG['basepath'] + '/Steam/build'
+
+    buildtargetid = build['buildtargetid']
+    buildospath = buildpath + '/' + buildtargetid
+
+    if buildtargetid == "":
+        log(" Missing field", logtype=LOG_ERROR)
+        return 5
+
+    if not simulate:
+        if os.path.exists(f"{buildospath}/{buildtargetid}_build.txt"):
+            os.remove(f"{buildospath}/{buildtargetid}_build.txt")
+
+    log(f" Preparing {buildtargetid}")
+    if "build" not in build:
+        log(" Missing builds field", logtype=LOG_ERROR, nodate=True)
+        return 6
+    downloadlink = build['links']['download_primary']['href']
+    buildid = build['build']
+
+    if build['finished'] == "":
+        log(" The build seems to be a failed one", logtype=LOG_ERROR, nodate=True)
+        return 7
+    finisheddate = datetime.strptime(build['finished'], "%Y-%m-%dT%H:%M:%S.%fZ")
+    currentdate = datetime.now()
+    timediff = currentdate - finisheddate
+    timediffinminute = int(timediff.total_seconds() / 60)
+    log(f"  Continuing with build #{buildid} for {buildtargetid} finished {timediffinminute} minutes ago...",
+        end="")
+    if timediffinminute > CFG['unity']['build_max_age'] and not settings['frombackup']:
+        if force:
+            log(f" Process forced to continue (--force flag used)", logtype=LOG_WARNING, nodate=True)
+        else:
+            log(' The build is too old (max ' + str(CFG['unity']['build_max_age']) + 'min)',
+                logtype=LOG_ERROR,
+                nodate=True)
+            return 8
+    else:
+        log(f"OK", logtype=LOG_SUCCESS, nodate=True)
+
+    # store the buildtargetid in a txt file for the late cleaning process
+    if not simulate:
+        if os.path.exists(f"{buildpath}/{buildtargetid}_build.txt"):
+            os.remove(f"{buildpath}/{buildtargetid}_build.txt")
+        write_in_file(f"{buildpath}/{buildtargetid}_build.txt", f"{buildtargetid}::{buildid}")
+
+    zipfile = CFG['basepath'] + '/ucb' + buildtargetid + '.zip'
+    # same key as the prefetch of the webhook handler: the branch is the beginning of the build target id, the
+    # startup script does not give --branch
+    buildbranch = buildtargetid.split("-")[0]
+    s3path = 'UCB/unity-builds/' + buildbranch + '/ucb' + buildtargetid + '.zip'
+    streambackup = get_config_value(['aws', 'stream_backup'], False)
+
+    journal = get_journal()
+    artifact = journal.get_target(buildtargetid, buildid)
+    # a build restored from the backup is not backed up again
+    backedup = journal.is_target_done(buildtargetid, buildid, 'backedup') or settings['frombackup']
+    if not simulate and backedup and journal.is_target_done(buildtargetid, buildid, 'extracted') and \
+            os.path.exists(buildospath):
+        log(f"  Build #{buildid} already downloaded, extracted and backed up by a previous run", logtype=LOG_SUCCESS)
+        return 0
+
+    # a zip downloaded by a previous run is reused once its hash is checked
+    reusezip = False
+    if not simulate and journal.is_target_done(buildtargetid, buildid, 'downloaded') and os.path.exists(zipfile):
+        log('  Checking the zip file downloaded by a previous run...', end="")
+        if file_sha256(zipfile) == artifact.get('sha256'):
+            reusezip = True
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+        else:
+            log("The hash does not match, downloading it again", logtype=LOG_WARNING, nodate=True)
+
+    # the backup is downloaded instead of the UCB artifact when restoring or when the webhook already prefetched it
+    backup = build.get('backup') if settings['frombackup'] else None
+    if not simulate and not reusezip and not settings['frombackup'] and \
+            get_config_value(['aws', 'use_prefetch'], True):
+        try:
+            backup = get_prefetched_backup(s3path, buildid)
+        except botocore_exceptions.ClientError as e:
+            log(f"  Cannot check the prefetched artifact: {e}", logtype=LOG_WARNING)
+        if backup is not None:
+            log(f"  Build #{buildid} already prefetched to S3 by the webhook")
+            backedup = True
+
+    # the parts of a backup without checksum cannot be verified: the artifact is fetched again from UCB when it
+    # still exists there, otherwise the backup is downloaded whole and its size checked
+    if not simulate and not reusezip and backup is not None and backup['sha256'] is None and buildid != 0:
+        ucbbuild = get_build(buildtargetid, buildid)
+        if ucbbuild is not None and ucbbuild.get('buildStatus') == 'success' and \
+                'download_primary' in ucbbuild.get('links', dict()):
+            log(f"  The backup of {buildtargetid} has no checksum, downloading build #{buildid} from UCB instead",
+                logtype=LOG_WARNING)
+            downloadlink = ucbbuild['links']['download_primary']['href']
+            backup = None
+            # the backup is replaced by one carrying the checksum
+            backedup = False
+
+    log(f"  Deleting old files in {buildospath}...", end="")
+    if not simulate:
+        if os.path.exists(zipfile) and not reusezip:
+            os.remove(zipfile)
+        if os.path.exists(f"{buildpath}/{buildtargetid}_version.txt"):
+            os.remove(f"{buildpath}/{buildtargetid}_version.txt")
+        if os.path.exists(buildospath):
+            shutil.rmtree(buildospath, ignore_errors=True)
+    log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    artifactmetadata = None
+    if reusezip:
+        artifactmetadata = {'sha256': artifact['sha256'], 'size': str(artifact['size']), 'build': str(buildid),
+                            'platform': build['platform']}
+    elif backup is not None:
+        log('  Downloading the backup ' + backup['key'] + '...', end="")
+        if not simulate:
+            try:
+                with get_resource('download'), profile_stage(f"download_{buildtargetid}"):
+                    download_start = time.time()
+                    if backup['sha256'] is None:
+                        if s3_download_file(backup['key'], CFG['aws']['s3bucket'], zipfile) != 0:
+                            raise OSError(f"the download of {backup['key']} failed")
+                        sha256 = file_sha256(zipfile)
+                    else:
+                        sha256 = s3_download_file_ranged(CFG['aws']['s3bucket'], backup['key'], zipfile,
+                                                         backup['size'],
+                                                         get_config_value(['aws', 'restore_part_size'], 16) * 1048576,
+                                                         get_config_value(['aws', 'restore_threads'], 8))
+            except (OSError, botocore_exceptions.ClientError, botocore_exceptions.BotoCoreError) as e:
+                log(f"Error downloading the backup: {e}", logtype=LOG_ERROR, nodate=True)
+                return 12
+            if backup['sha256'] is None and os.path.getsize(zipfile) != backup['size']:
+                log(f"The backup is truncated ({os.path.getsize(zipfile)} bytes instead of {backup['size']})",
+                    logtype=LOG_ERROR, nodate=True)
+                return 12
+            if backup['sha256'] is not None and sha256 != backup['sha256']:
+                log(f"The backup is corrupted (sha256 {sha256} instead of {backup['sha256']})",
+                    logtype=LOG_ERROR, nodate=True)
+                return 12
+            record_metric('artifacts', buildtargetid, {'build': buildid, 'sha256': sha256, 'size': backup['size']})
+            record_stage(buildtargetid, 'download', download_start)
+            journal.mark_target(buildtargetid, buildid, 'downloaded', {'sha256': sha256, 'size': backup['size']})
+            if not settings['frombackup']:
+                journal.mark_target(buildtargetid, buildid, 'backedup')
+        log("OK", logtype=LOG_SUCCESS, nodate=True)
+    else:
+        streaming = streambackup and not backedup
+        log('  Downloading the built zip file ' + zipfile + '...', end="")
+        if not simulate:
+            upload = None
+            try:
+                if streaming:
+                    upload = S3StreamUpload(CFG['aws']['s3bucket'], s3path,
+                                            get_config_value(['aws', 'part_size'], 64) * 1048576,
+                                            get_config_value(['aws', 'max_buffered_parts'], 4))
+                with get_resource('download'), profile_stage(f"download_{buildtargetid}"):
+                    download_start = time.time()
+                    sha256, size = download_file(downloadlink, zipfile, upload=upload)
+            except (requests.exceptions.RequestException, OSError, botocore_exceptions.ClientError,
+                    botocore_exceptions.BotoCoreError) as e:
+                if upload is not None:
+                    upload.abort()
+                log(f"Error downloading the build: {e}", logtype=LOG_ERROR, nodate=True)
+                return 12
+            artifactmetadata = {'sha256': sha256, 'size': str(size), 'build': str(buildid),
+                                'platform': build['platform']}
+            record_metric('artifacts', buildtargetid, {'build': buildid, 'sha256': sha256, 'size': size})
+            record_stage(buildtargetid, 'download', download_start)
+            journal.mark_target(buildtargetid, buildid, 'downloaded', {'sha256': sha256, 'size': size})
+        log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+        if streaming:
+            # the backup was streamed during the download: only the last parts remain
+            log('  Completing the copy streamed to S3 ' + s3path + ' ...', end="")
+            ok = 0
+            if not simulate:
+                try:
+                    with get_resource('backup'), profile_stage(f"backup_{buildtargetid}"):
+                        backup_start = time.time()
+                        upload.complete(artifactmetadata)
+                except botocore_exceptions.ClientError as e:
+                    upload.abort()
+                    log(e.response['Error']['Message'], logtype=LOG_ERROR, nodate=True)
+                    ok = 450
+                except botocore_exceptions.BotoCoreError as e:
+                    upload.abort()
+                    log(str(e), logtype=LOG_ERROR, nodate=True)
+                    ok = 450
+                record_stage(buildtargetid, 'backup', backup_start)
+
+            if ok != 0:
+                log('Error uploading file "ucb' + buildtargetid + '.zip" to AWS ' + s3path + '. Check the IAM permissions',
+                    logtype=LOG_ERROR, nodate=True)
+                return 9
+            backedup = True
+            if not simulate:
+                journal.mark_target(buildtargetid, buildid, 'backedup')
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    exclusions = get_extract_exclusions(buildtargetid)
+    symbolsfile = CFG['basepath'] + '/ucb' + buildtargetid + '_symbols.zip'
+    symbolpatterns = None
+    if get_config_value(['disk', 'symbols', 'enabled'], False):
+        symbolpatterns = get_config_value(['disk', 'symbols', 'patterns'], ['*.pdb'])
+
+    log('  Extracting the zip file in ' + buildospath + '...', end="")
+    if not simulate:
+        with get_resource('extract'), profile_stage(f"extract_{buildtargetid}"), ZipFile(zipfile, "r") as zipObj, \
+                (ZipFile(symbolsfile, "w", ZIP_DEFLATED) if symbolpatterns is not None
+                 else contextlib.nullcontext()) as symbols:
+            extract_start = time.time()
+            # the central directory gives the extracted size without reading the archive
+            extractedsize = sum(info.file_size for info in zipObj.infolist()
+                                if not match_patterns(info.filename, exclusions))
+            freespace = shutil.disk_usage(CFG['basepath']).free
+            if extractedsize > freespace:
+                log(f"Not enough disk space to extract {extractedsize / 1073741824:.2f}GB "
+                    f"({freespace / 1073741824:.2f}GB free)", logtype=LOG_ERROR, nodate=True)
+                return 13
+            versions, linkedsize, excludedsize = extract_zip(zipObj, buildospath, deduplicator=get_deduplicator(),
+                                                             exclusions=exclusions, symbols=symbols,
+                                                             symbolpatterns=symbolpatterns)
+            record_metric('artifacts', buildtargetid, {'extracted_size': extractedsize, 'linked_size': linkedsize,
+                                                       'excluded_size': excludedsize})
+            if linkedsize > 0:
+                log(f"{linkedsize / 1048576:.1f}MB hardlinked from other builds...", nodate=True, end="")
+            if excludedsize > 0:
+                log(f"{excludedsize / 1048576:.1f}MB excluded...", nodate=True, end="")
+            # keep the version next to the build for the next steps
+            if len(versions) == 1:
+                write_in_file(f"{buildpath}/{buildtargetid}_version.txt", versions[0])
+                record_metric('artifacts', buildtargetid, {'version': versions[0]})
+        record_stage(buildtargetid, 'extract', extract_start)
+        journal.mark_target(buildtargetid, buildid, 'extracted')
+    log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    # the symbols are kept apart for the crash analysis, a failure does not stop the deployment
+    if not simulate and symbolpatterns is not None and os.path.exists(symbolsfile):
+        with ZipFile(symbolsfile, "r") as symbols:
+            symbolscount = len(symbols.infolist())
+        if symbolscount > 0:
+            symbolspath = get_config_value(['disk', 'symbols', 'prefix'], 'UCB/symbols/') + buildbranch + '/' + \
+                buildtargetid + '/' + str(buildid) + '.zip'
+            log(f'  Uploading {symbolscount} symbol files to S3 {symbolspath}...', end="")
+            with get_resource('backup'):
+                ok = s3_upload_file(symbolsfile, CFG['aws']['s3bucket'], symbolspath, {'build': str(buildid)})
+            if ok != 0:
+                log("Error uploading the symbols", logtype=LOG_WARNING, nodate=True)
+            else:
+                log("OK", logtype=LOG_SUCCESS, nodate=True)
+        os.remove(symbolsfile)
+
+    if not backedup:
+        log('  Uploading copy to S3 ' + s3path + ' ...', end="")
+        if not simulate:
+            with get_resource('backup'), profile_stage(f"backup_{buildtargetid}"):
+                backup_start = time.time()
+                ok = s3_upload_file(zipfile, CFG['aws']['s3bucket'], s3path, artifactmetadata)
+                record_stage(buildtargetid, 'backup', backup_start)
+        else:
+            ok = 0
+
+        if ok != 0:
+            log('Error uploading file "ucb' + buildtargetid + '.zip" to AWS ' + s3path + '. Check the IAM permissions',
+                logtype=LOG_ERROR, nodate=True)
+            return 9
+        if not simulate:
+            journal.mark_target(buildtargetid, buildid, 'backedup')
+        log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    # the zip is not needed anymore once extracted and backed up
+    if not simulate and not get_config_value(['disk', 'keep_zip'], False):
+        if os.path.exists(zipfile):
+            os.remove(zipfile)
+
+    return 0
+
+
+def read_build_version(buildtargetid):
+    # version read from UCB_version.txt when the build was extracted, None if there is none
+    pathFileVersion = f"{CFG['basepath']}/Steam/build/{buildtargetid}_version.txt"
+    if not os.path.exists(pathFileVersion):
+        return None
+    return read_from_file(pathFileVersion).rstrip('\n')
+
+
+def init_upload_status(packageuploadsuccess, packages, packagecomplete, store):
+    # create the structure used to identify the upload success for a complete package
+    for package in packages.keys():
+        if packagecomplete[package][store]:
+            if package not in packageuploadsuccess:
+                packageuploadsuccess[package] = dict()
+
+            for buildtarget in CFG['buildtargets']:
+                for buildtargetid in buildtarget.keys():
+                    if store in buildtarget[buildtargetid]:
+                        if buildtarget[buildtargetid][store]['package'] == package:
+                            if buildtargetid not in packageuploadsuccess[package]:
+                                packageuploadsuccess[package][buildtargetid] = dict()
+                            packageuploadsuccess[package][buildtargetid][store] = False
+
+
+def prepare_steam_package(package, steampackages, packageuploadsuccess, steam_appversion, settings):
+    # write the app build file of the package and the depot build files of its builds, return the app build file
+    # (one per package: several packages of the same app are built in the same steamcmd session)
+    global CFG
+
+    nolive = settings['nolive']
+    simulate = settings['simulate']
+
+    first = True
+    app_id = ""
+    appbuildfile = ""
+
+    for buildtargetid in steampackages[package].keys():
+        # TODO
+        # filter on the platform we want (if platform is empty, it means that we must do it for all
+        # if build['platform'] == platform or platform == "":
+        # store the data necessary for the next steps
+
+        # find the data related to the branch we want to build
+        for buildtarget in CFG['buildtargets']:
+            if buildtargetid in buildtarget.keys():
+                if 'steam' in buildtarget[buildtargetid]:
+                    package = buildtarget[buildtargetid]['steam']['package']
+                    depot_id = buildtarget[buildtargetid]['steam']['depot_id']
+                    branch_name = buildtarget[buildtargetid]['steam']['branch_name']
+                    live = buildtarget[buildtargetid]['steam']['live']
+
+                    # now prepare the steam files
+                    # first time we loop: prepare the main steam file
+                    if first:
+                        first = False
+
+                        app_id = buildtarget[buildtargetid]['steam']['app_id']
+                        appbuildfile = f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}_{package}.vdf"
+                        log(f' Preparing main Steam file for app {app_id}...', end="")
+                        if not simulate:
+                            shutil.copyfile(f"{CFG['basepath']}/Steam/scripts/template_app_build.vdf", appbuildfile)
+
+                            replace_in_file(appbuildfile, "%basepath%", CFG['basepath'])
+                            replace_in_file(appbuildfile, "%version%", steam_appversion)
+                            replace_in_file(appbuildfile, "%branch_name%", branch_name)
+                            replace_in_file(appbuildfile, "%app_id%", app_id)
+
+                            if not nolive:
+                                replace_in_file(appbuildfile, "%live%", live)
+                            else:
+                                replace_in_file(appbuildfile, "%live%", "")
+                        log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+                        # then the depot files
+                    log(f' Preparing platform Steam file for depot {depot_id} / {buildtargetid}...', end="")
+                    if not simulate:
+                        shutil.copyfile(
+                            f"{CFG['basepath']}/Steam/scripts/template_depot_build_buildtarget.vdf",
+                            f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf")
+
+                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf",
+                                        "%depot_id%", depot_id)
+                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf",
+                                        "%buildtargetid%", buildtargetid)
+                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf",
+                                        "%basepath%", CFG['basepath'])
+
+                        data = vdf.load(open(appbuildfile))
+                        data['appbuild']['depots'][depot_id] = f"depot_build_{buildtargetid}.vdf"
+
+                        indented_vdf = vdf.dumps(data, pretty=True)
+
+                        write_in_file(appbuildfile, indented_vdf)
+
+                    packageuploadsuccess[package][buildtargetid]['steam'] = True
+
+                    log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    if app_id == "":
+        return None
+    return app_id, appbuildfile
+
+
+def run_command(cmd):
+    # run a command showing its output as before, return its exitcode and the lines read with their time
+    # a missing or not executable program fails like in a shell instead of raising
+    try:
+        process = subprocess.Popen(cmd, shell=isinstance(cmd, str), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, errors='replace')
+    except OSError as e:
+        log(f"{cmd if isinstance(cmd, str) else cmd[0]} cannot be executed: {e}", logtype=LOG_ERROR)
+        return 127, list()
+    output = list()
+    for line in process.stdout:
+        sys.stdout.write(line)
+        output.append((time.time(), line))
+    return process.wait(), output
+
+
+def parse_size(value, unit):
+    # 12.5 MB, 3.2 MiB, 1024 bytes...
+    multiplier = 1
+    if unit[0].upper() in 'KMGT':
+        multiplier = 1024 ** ('KMGT'.index(unit[0].upper()) + 1)
+    return int(float(value) * multiplier)
+
+
+def finish_upload_record(record, end):
+    record['duration'] = end - record.pop('start')
+    transferred = record.get('patch_bytes', record.get('new_bytes'))
+    if transferred is not None and record['duration'] > 0:
+        record['upload_rate'] = transferred / record['duration']
+
+
+def parse_steamcmd_output(output, success):
+    # one record per depot built by an app build (its output split by split_steamcmd_output): new/reused chunks and
+    # bytes, manifest, duration and the build id, left empty when the build failed
+    # the summary lines of SteamPipe are not a stable format: the values not found are left out
+    records = list()
+    record = None
+    buildid = None
+    for timestamp, line in output:
+        depotmatch = re.search(r"Building depot (\d+)", line)
+        resultmatch = re.search(r"Successfully finished AppID \d+ build(?: \(BuildID (\d+)\))?|"
+                                r"(?:ERROR|[Ff]ailed).*AppID \d+", line)
+        # the last depot ends with the result line of its own build
+        if record is not None and (depotmatch or resultmatch):
+            finish_upload_record(record, timestamp)
+            record = None
+        if depotmatch:
+            record = {'depot_id': depotmatch.group(1), 'start': timestamp}
+            records.append(record)
+            continue
+        if resultmatch:
+            buildid = resultmatch.group(1)
+            continue
+        if record is None:
+            continue
+
+        manifestmatch = re.search(r"[Mm]anifest(?: ?(?:ID|GID))?\D{0,4}(\d{6,})", line)
+        if manifestmatch:
+            record['manifest'] = manifestmatch.group(1)
+        for count, kind in re.findall(r"(\d+)\s+(new|changed|uploaded|reused|unchanged)\s+chunks?", line, re.I):
+            field = 'reused_chunks' if kind.lower() in ('reused', 'unchanged') else 'new_chunks'
+            record[field] = record.get(field, 0) + int(count)
+        for value, unit, kind in re.findall(r"([\d.]+)\s*([KMGT]i?B|bytes)\s+(new|changed|uploaded|reused|unchanged)",
+                                            line, re.I):
+            field = 'reused_bytes' if kind.lower() in ('reused', 'unchanged') else 'new_bytes'
+            record[field] = record.get(field, 0) + parse_size(value, unit)
+    if record is not None:
+        finish_upload_record(record, output[-1][0])
+    for record in records:
+        record['build_id'] = buildid if success else None
+    return records
+
+
+def parse_butler_output(output):
+    # size pushed, fresh data, patch size and builds of a butler push
+    record = {'start': output[0][0] if len(output) > 0 else time.time()}
+    for timestamp, line in output:
+        match = re.search(r"Pushing ([\d.]+) (\S+) \((\d+) files", line)
+        if match:
+            record['size'] = parse_size(match.group(1), match.group(2))
+            record['files'] = int(match.group(3))
+        match = re.search(r"Re-used ([\d.]+)% of old, added ([\d.]+) (\S+) fresh data", line)
+        if match:
+            record['reused_ratio'] = float(match.group(1)) / 100
+            record['new_bytes'] = parse_size(match.group(2), match.group(3))
+        match = re.search(r"([\d.]+) (\S+) patch \(([\d.]+)% savings\)", line)
+        if match:
+            record['patch_bytes'] = parse_size(match.group(1), match.group(2))
+        match = re.search(r"last build is (\d+)", line)
+        if match:
+            record['parent_build_id'] = match.group(1)
+        match = re.search(r"(?:[Cc]reated|[Nn]ew) build (\d+)", line)
+        if match:
+            record['build_id'] = match.group(1)
+    if 'size' in record and 'new_bytes' in record:
+        record['reused_bytes'] = max(record['size'] - record['new_bytes'], 0)
+    finish_upload_record(record, output[-1][0] if len(output) > 0 else time.time())
+    return record
+
+
+def split_steamcmd_output(output, appbuilds, appdepots):
+    # split the output of a steamcmd session running several app builds in order into the output of each build
+    # a build starts with the "Building depot" line of one of its depots and ends with its result line, a build
+    # that never started or that has no success line failed; when a result cannot be attributed to a build, all
+    # the builds of its app are considered failed
+    # the packages of an app can share their depots: a depot built again starts the next build
+    segments = [{'lines': list(), 'success': False} for appbuild in appbuilds]
+    unattributed = set()
+    current = None
+    currentdepots = set()
+    nextindex = 0
+    for timestamp, line in output:
+        depotmatch = re.search(r"Building depot (\d+)", line)
+        if depotmatch and (current is None or depotmatch.group(1) not in appdepots[current] or
+                           depotmatch.group(1) in currentdepots):
+            current = None
+            currentdepots = set()
+            for index in range(nextindex, len(appbuilds)):
+                if depotmatch.group(1) in appdepots[index]:
+                    current = index
+                    nextindex = index + 1
+                    break
+        if depotmatch:
+            currentdepots.add(depotmatch.group(1))
+        successmatch = re.search(r"Successfully finished AppID (\d+) build", line)
+        failurematch = re.search(r"(?:ERROR|[Ff]ailed).*AppID (\d+)", line)
+        resultmatch = successmatch or failurematch
+        if resultmatch and (current is None or str(appbuilds[current][0]) != resultmatch.group(1)):
+            # a build that ended before building any depot (ex: invalid app build file): the result is the one of
+            # the next build of its app
+            current = None
+            for index in range(nextindex, len(appbuilds)):
+                if str(appbuilds[index][0]) == resultmatch.group(1):
+                    current = index
+                    nextindex = index + 1
+                    break
+            if current is None:
+                # a success may belong to any build of its app
+                if successmatch:
+                    unattributed.add(successmatch.group(1))
+                continue
+        if current is None:
+            continue
+        segments[current]['lines'].append((timestamp, line))
+        if resultmatch:
+            segments[current]['success'] = successmatch is not None
+            current = None
+
+    for (app_id, appbuildfile), segment in zip(appbuilds, segments):
+        if str(app_id) in unattributed:
+            segment['success'] = False
+    if len(unattributed) > 0:
+        log(f" The steamcmd output of the app(s) {', '.join(sorted(unattributed))} cannot be split between their "
+            f"builds, they are considered failed", logtype=LOG_WARNING, nodate=True)
+    return segments
+
+
+def run_steam_builds(appbuilds, simulate=False):
+    # build several apps with a single steamcmd login, return the success of each (app_id, app build file) in order
+    cmd = [f"{CFG['basepath']}/Steam/steamcmd/steamcmd.sh", "+login", CFG['steam']['user'], CFG['steam']['password']]
+    for app_id, appbuildfile in appbuilds:
+        cmd += ["+run_app_build", appbuildfile]
+    cmd += ["+quit"]
+
+    if simulate:
+        log("  " + " ".join(cmd[:2] + ['"' + CFG['steam']['user'] + '"', '"' + CFG['steam']['password'] + '"'] +
+                            cmd[4:]))
+        return [True] * len(appbuilds)
+
+    # the depots of each app build tell which build the output belongs to, and their build target
+    # (depot_build_<buildtargetid>.vdf) as the packages of an app can share their depots
+    appdepots = list()
+    for app_id, appbuildfile in appbuilds:
+        with open(appbuildfile) as file:
+            depots = vdf.load(file)['appbuild']['depots']
+        appdepots.append({str(depot_id): re.sub(r"^depot_build_(.*)\.vdf$", r"\1", os.path.basename(depotfile))
+                          for depot_id, depotfile in depots.items()})
+
+    # the output is shown as before and kept to find the result of each app build
+    with reserve_bandwidth():
+        returncode, output = run_command(cmd)
+
+    segments = split_steamcmd_output(output, appbuilds, appdepots)
+    for (app_id, appbuildfile), depots, segment in zip(appbuilds, appdepots, segments):
+        for record in parse_steamcmd_output(segment['lines'], segment['success']):
+            name = get_metric_name(depots.get(record['depot_id'], f"depot{record['depot_id']}"))
+            record.update({'name': name, 'store': 'steam', 'app_id': str(app_id)})
+            record_metric('uploads', f"{name}/steam", record)
+
+    results = [segment['success'] for segment in segments]
+
+    if returncode != 0 and all(results):
+        # steamcmd failed after the builds (or its output changed): nothing can be trusted
+        log(f" steamcmd ended with the exitcode {returncode}", logtype=LOG_WARNING, nodate=True)
+        results = [False] * len(appbuilds)
+    return results
+
+
+def upload_steam_packages(packages, packagecomplete, steampackages, packageuploadsuccess, steam_appversion,
+                          settings, versions=None):
+    # upload the given complete packages to Steam in a single steamcmd session
+    # versions: version of each package when they differ (pipeline), steam_appversion otherwise
+    global CFG
+
+    platform = settings['platform']
+    simulate = settings['simulate']
+
+    appbuilds = list()
+    batch = list()
+    for package in packages:
+        buildnumbers = get_package_buildnumbers(packagecomplete[package], platform)
+        if not simulate and get_journal().is_package_done(package, buildnumbers, 'steam'):
+            log(f' Package {package} was already uploaded to Steam by a previous run', logtype=LOG_SUCCESS)
+            for buildtargetid, buildtargetvalue in packageuploadsuccess[package].items():
+                if 'steam' in buildtargetvalue:
+                    buildtargetvalue['steam'] = True
+            continue
+
+        log(f'Starting Steam process for package {package}...')
+        appbuild = prepare_steam_package(package, steampackages, packageuploadsuccess,
+                                         versions[package] if versions is not None else steam_appversion, settings)
+        if appbuild is None:
+            log("app_id is empty", logtype=LOG_ERROR, nodate=True)
+            return 9
+        appbuilds.append(appbuild)
+        batch.append((package, buildnumbers))
+
+    if len(appbuilds) == 0:
+        return 0
+
+    if not check_lease(settings):
+        return 60
+    log(f" Building Steam packages {', '.join(package for package, buildnumbers in batch)}...")
+    if not simulate:
+        restore_steamcmd_bundle()
+    steam_start = time.time()
+    results = run_steam_builds(appbuilds, simulate)
+
+    returncode = 0
+    for (package, buildnumbers), (app_id, appbuildfile), success in zip(batch, appbuilds, results):
+        if not simulate:
+            record_stage(get_metric_name(package), 'steam', steam_start)
+        if success:
+            if not simulate:
+                get_journal().mark_package(package, buildnumbers, 'steam')
+            log(f" Package {package} built for app {app_id}", logtype=LOG_SUCCESS)
+        else:
+            for buildtargetid, buildtargetvalue in packageuploadsuccess[package].items():
+                if 'steam' in buildtargetvalue:
+                    buildtargetvalue['steam'] = False
+            log(f" Executing the bash file {CFG['basepath']}/Steam/steamcmd/steamcmd.sh for package {package} "
+                f"(app {app_id}) failed", logtype=LOG_ERROR)
+            returncode = 9
+
+    return returncode
+
+
+def upload_butler_package(package, packagecomplete, butlerpackages, packageuploadsuccess, steam_appversion, settings,
+                          buildtargetids=None):
+    # push the builds of the package (or only the given ones) to itch.io
+    global CFG
+
+    simulate = settings['simulate']
+
+    if not check_lease(settings):
+        return 60
+    log(f'Starting Butler process for package {package}...')
+    buildnumbers = get_package_buildnumbers(packagecomplete[package], settings['platform'])
+    if buildtargetids is None:
+        buildtargetids = butlerpackages[package].keys()
+
+    for buildtargetid in buildtargetids:
+        # TODO
+        # filter on the platform we want (if platform is empty, it means that we must do it for all
+        # if build['platform'] == platform or platform == "":
+        # store the data necessary for the next steps
+
+        found = False
+        # find the data related to the branch we want to build
+        for buildtarget in CFG['buildtargets']:
+            if buildtargetid in buildtarget.keys():
+                if 'butler' in buildtarget[buildtargetid]:
+                    package = buildtarget[buildtargetid]['butler']['package']
+                    butler_channel = buildtarget[buildtargetid]['butler']['channel']
+                    buildpath = f"{CFG['basepath']}/Steam/build/{buildtargetid}"
+
+                    found = True
+                    buildid = buildnumbers.get(buildtargetid)
+                    if not simulate and get_journal().is_target_done(buildtargetid, buildid, 'butler'):
+                        log(f" Build {buildtargetid} was already pushed to itch.io(Butler) by a previous run",
+                            logtype=LOG_SUCCESS)
+                        packageuploadsuccess[package][buildtargetid]['butler'] = True
+                        continue
+
+                    log(f" Building itch.io(Butler) {buildtargetid} packages...", end="")
+                    cmd = f"{CFG['basepath']}/Butler/butler push {buildpath} {CFG['butler']['org']}/{CFG['butler']['project']}:{butler_channel} --userversion={steam_appversion} --if-changed"
+                    if not simulate:
+                        butler_start = time.time()
+                        with reserve_bandwidth():
+                            ok, output = run_command(cmd)
+                        record_stage(buildtargetid, 'butler', butler_start)
+                        record = parse_butler_output(output)
+                        record.update({'name': get_metric_name(buildtargetid), 'store': 'butler',
+                                       'channel': butler_channel})
+                        record_metric('uploads', f"{record['name']}/butler", record)
+                    else:
+                        ok = 0
+
+                    if ok != 0:
+                        log(f"Executing Butler {CFG['basepath']}/Butler/butler (exitcode={ok})",
+                            logtype=LOG_ERROR)
+                        return 10
+
+                    packageuploadsuccess[package][buildtargetid]['butler'] = True
+                    if not simulate:
+                        get_journal().mark_target(buildtargetid, buildid, 'butler')
+
+                    log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+                    if simulate:
+                        log("  " + cmd)
+
+        if not found:
+            log(f"There is no Butler configuration for the target {buildtargetid}", logtype=LOG_WARNING)
+
+    return 0
+
+
+def clean_packages(packageuploadsuccess, builds, settings):
+    # delete from UCB the builds of the packages successfully uploaded to Steam or Butler
+    simulate = settings['simulate']
+
+    keep_success_count = int(get_config_value(['unity', 'cleanup', 'keep_success_count'], 0))
+    failure_retention_days = float(get_config_value(['unity', 'cleanup', 'failure_retention_days'], 0))
+    buildstodelete = list()
+    cleanedpackages = list()
+    # let's remove the build successfully uploaded to Steam or Butler from UCB
+    # clean only the packages that are successful
+    for package, packagevalue in packageuploadsuccess.items():
+        complete = True
+        for buildtarget, buildtargetvalue in packagevalue.items():
+            for uploadprocess, uploadprocessvalue in buildtargetvalue.items():
+                if not uploadprocessvalue:
+                    complete = False
+
+        if complete:
+            log(f" Cleaning package {package}...")
+            cleanedpackages.append(package)
+            if not simulate:
+                get_journal().mark_deployed(package, get_package_buildnumbers(
+                    {'builds': [build for build in builds['success'] if build['buildtargetid'] in packagevalue.keys()]},
+                    settings['platform']))
+            # cleanup everything related to this package
+            packagebuilds = list()
+            for build in builds['success'] + builds['building'] + builds['failure'] + builds['canceled']:
+                if build['buildtargetid'] in packagevalue.keys():
+                    packagebuilds.append(build)
+
+            for build in select_builds_to_delete(packagebuilds, keep_success_count, failure_retention_days):
+                buildid = build['build']
+                if (build['buildtargetid'], buildid) not in buildstodelete:
+                    log(f"  Build #{buildid} for buildtarget {build['buildtargetid']} will be deleted (status: {build['buildStatus']})")
+                    buildstodelete.append((build['buildtargetid'], buildid))
+
+    failed = list()
+    if len(buildstodelete) > 0 and not check_lease(settings):
+        return
+    if len(buildstodelete) > 0:
+        batch_size = int(get_config_value(['unity', 'cleanup', 'batch_size'], 50))
+        log(f" Deleting {len(buildstodelete)} builds (batches of {batch_size})...", end="")
+        if not simulate:
+            cleanup_start = time.time()
+            failed = delete_builds(buildstodelete, batch_size, get_config_value(['unity', 'cleanup', 'threads'], 4))
+            record_stage(get_metric_name('ucb'), 'cleanup', cleanup_start)
+
+        if len(failed) > 0:
+            log(f"{len(failed)} builds were not deleted", logtype=LOG_ERROR, nodate=True)
+            for buildtargetid, buildid, error in failed:
+                log(f"  Build #{buildid} for buildtarget {buildtargetid} was not deleted: {error}", logtype=LOG_ERROR)
+        else:
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    # the packages entirely cleaned have nothing left to resume (even when all their builds are kept in UCB)
+    if not simulate:
+        failedtargets = set(buildtargetid for buildtargetid, buildid, error in failed)
+        for package in cleanedpackages:
+            if len(failedtargets & set(packageuploadsuccess[package].keys())) == 0:
+                get_journal().forget_package(package, packageuploadsuccess[package].keys())
+
+
+def process_packages(packagecomplete, steampackages, butlerpackages, builds, settings):
+    # download, upload to the stores then clean the given packages
+    global CFG
+
+    if get_config_value(['pipeline', 'enabled'], False):
+        return pipeline_packages(packagecomplete, steampackages, butlerpackages, builds, settings)
+
+    platform = settings['platform']
+    steam_appversion = settings['version']
+    nodownload = settings['nodownload']
+    noupload = settings['noupload']
+    noclean = settings['noclean']
+    simulate = settings['simulate']
+
+    buildpath = CFG['basepath'] + '/Steam/build'
+    packageuploadsuccess = dict()
+
+    # download the builds from UCB
+    if not nodownload:
+        log("--------------------------------------------------------------------------", nodate=True)
+        log("Downloading build from UCB...")
+        for package, packagevalue in packagecomplete.items():
+            for build in packagevalue['builds']:
+                # filter on the platform we want (if platform is empty, it means that we must do it for all
+                if build['platform'] == platform or platform == "":
+                    # store the data necessary for the next steps
+                    returncode = download_build(build, settings)
+                    if returncode != 0:
+                        return returncode
+
+    log("--------------------------------------------------------------------------", nodate=True)
+    log("Get version from source file...")
+    for package, packagevalue in packagecomplete.items():
+        for build in packagevalue['builds']:
+            buildtargetid = build['buildtargetid']
+            buildospath = buildpath + '/' + buildtargetid
+
+            if steam_appversion == "":
+                log('  Get the version of the build from files...', end="")
+                version = read_build_version(buildtargetid)
+                if version is not None:
+                    steam_appversion = version
+
+                    if steam_appversion != "":
+                        log(" " + steam_appversion + " ", logtype=LOG_INFO, nodate=True, end="")
+                        log("OK ", logtype=LOG_SUCCESS, nodate=True)
+                else:
+                    log(f"File version UCB_version.txt was not found in build directory {buildospath}",
+                        logtype=LOG_WARNING, nodate=True)
+
+    if not noupload:
+        log("--------------------------------------------------------------------------", nodate=True)
+        log("Uploading files to stores...")
+
+        # region STEAM
+        init_upload_status(packageuploadsuccess, steampackages, packagecomplete, 'steam')
+        completepackages = list()
+        for package in steampackages.keys():
+            # we only want to build the packages that are complete
+            if packagecomplete[package]['steam']:
+                completepackages.append(package)
+            else:
+                log(f' Package {package} is not complete and will not be processed for Steam...', logtype=LOG_WARNING)
+
+        # all the packages are built with a single steamcmd login
+        returncode = upload_steam_packages(completepackages, packagecomplete, steampackages, packageuploadsuccess,
+                                           steam_appversion, settings)
+        if returncode != 0:
+            return returncode
+
+        if not simulate and STEAMCMD_BUNDLE['checked']:
+            save_steamcmd_bundle()
+        # endregion
+
+        # region BUTLER
+        init_upload_status(packageuploadsuccess, butlerpackages, packagecomplete, 'butler')
+        for package in butlerpackages.keys():
+            # we only want to build the packages that are complete
+            if packagecomplete[package]['butler']:
+                returncode = upload_butler_package(package, packagecomplete, butlerpackages, packageuploadsuccess,
+                                                   steam_appversion, settings)
+                if returncode != 0:
+                    return returncode
+            else:
+                log(f' Package {package} is not complete and will not be processed for Butler...', logtype=LOG_WARNING)
+        # endregion
+
+    if not noclean:
+        log("--------------------------------------------------------------------------", nodate=True)
+        log("Cleaning successfully upload build in UCB...")
+        with profile_stage('cleanup'):
+            clean_packages(packageuploadsuccess, builds, settings)
+
+    return 0
+
+
+@contextlib.contextmanager
+def log_context(prefix):
+    # the lines logged by the thread are written whole and prefixed: the stages running in parallel do not mix them
+    LOG_CONTEXT.prefix = prefix
+    LOG_CONTEXT.pending = list()
+    try:
+        yield
+    finally:
+        if len(LOG_CONTEXT.pending) > 0:
+            log("", nodate=True)
+        LOG_CONTEXT.prefix = None
+
+
+def get_resource(name):
+    # semaphore limiting the number of stages using a resource at the same time (pipeline.limits.<name>)
+    with RESOURCES_LOCK:
+        if name not in RESOURCES:
+            RESOURCES[name] = threading.BoundedSemaphore(
+                int(get_config_value(['pipeline', 'limits', name], RESOURCE_LIMITS[name])))
+        return RESOURCES[name]
+
+
+def pipeline_packages(packagecomplete, steampackages, butlerpackages, builds, settings):
+    # each build goes through download, extract and backup on its own, the Steam upload of a package starts as soon
+    # as its builds are ready (with the other packages ready at that time) and the Butler upload of a build as soon
+    # as it is ready; get_resource() bounds the number of stages running at the same time for each resource
+    platform = settings['platform']
+    noupload = settings['noupload']
+    simulate = settings['simulate']
+
+    packageuploadsuccess = dict()
+    failed = threading.Event()
+
+    # a build target can belong to a Steam package and a Butler package: it is downloaded once
+    targetbuilds = dict()
+    for package, packagevalue in packagecomplete.items():
+        for build in packagevalue['builds']:
+            if build['platform'] == platform or platform == "":
+                targetbuilds[build['buildtargetid']] = build
+
+    def download(build):
+        if settings['nodownload'] or failed.is_set():
+            return 0
+        with log_context(build['buildtargetid']):
+            returncode = download_build(build, settings)
+        if returncode != 0:
+            failed.set()
+        return returncode
+
+    def get_version(package):
+        # each package is uploaded with the version of its own builds
+        if settings['version'] != "":
+            return settings['version']
+        for build in packagecomplete[package]['builds']:
+            version = read_build_version(build['buildtargetid'])
+            if version:
+                return version
+        log(f" No version found in the builds of package {package}", logtype=LOG_WARNING)
+        return ""
+
+    def wait_for_targets(buildtargetids):
+        for buildtargetid in buildtargetids:
+            if buildtargetid in downloads:
+                returncode = downloads[buildtargetid].result()
+                if returncode != 0:
+                    return returncode
+        return 0
+
+    # the packages ready while a steamcmd session runs are uploaded together by the next session (one login)
+    steamlock = threading.Lock()
+    steamqueue = list()
+    steamresults = dict()
+    steamdone = {package: threading.Event() for package in steampackages.keys()}
+
+    def upload_steam(package):
+        returncode = wait_for_targets(steampackages[package].keys())
+        if returncode != 0 or failed.is_set():
+            return returncode
+        with steamlock:
+            steamqueue.append(package)
+        with get_resource('steam'), log_context('steam'):
+            with steamlock:
+                batch = list(steamqueue)
+                steamqueue.clear()
+            if len(batch) > 0:
+                # the packages of the batch are released even when the session raises: they wait for it
+                returncode = 9
+                try:
+                    returncode = upload_steam_packages(batch, packagecomplete, steampackages, packageuploadsuccess,
+                                                       "", settings, {queued: get_version(queued) for queued in batch})
+                finally:
+                    with steamlock:
+                        for queued in batch:
+                            steamresults[queued] = returncode
+                            steamdone[queued].set()
+        # the package may be in the batch of another session
+        steamdone[package].wait()
+        returncode = steamresults[package]
+        if returncode != 0:
+            failed.set()
+        return returncode
+
+    def upload_butler(package, buildtargetid):
+        returncode = wait_for_targets([buildtargetid])
+        if returncode != 0 or failed.is_set():
+            return returncode
+        with get_resource('butler'), log_context(buildtargetid):
+            returncode = upload_butler_package(package, packagecomplete, butlerpackages, packageuploadsuccess,
+                                               get_version(package), settings, [buildtargetid])
+        if returncode != 0:
+            failed.set()
+        return returncode
+
+    def run_task(function, *args):
+        # a stage raising stops the other ones like a failed stage
+        try:
+            return function(*args)
+        except Exception:
+            failed.set()
+            raise
+
+    log("--------------------------------------------------------------------------", nodate=True)
+    log(f"Processing {len(targetbuilds)} builds through the pipeline...")
+
+    if not noupload:
+        init_upload_status(packageuploadsuccess, steampackages, packagecomplete, 'steam')
+        init_upload_status(packageuploadsuccess, butlerpackages, packagecomplete, 'butler')
+        for package in steampackages.keys():
+            if not packagecomplete[package]['steam']:
+                log(f' Package {package} is not complete and will not be processed for Steam...', logtype=LOG_WARNING)
+        for package in butlerpackages.keys():
+            if not packagecomplete[package]['butler']:
+                log(f' Package {package} is not complete and will not be processed for Butler...', logtype=LOG_WARNING)
+
+    # every task has its own thread: the upload tasks wait for the downloads they depend on
+    tasks = list()
+    with ThreadPoolExecutor(max_workers=max(1, len(targetbuilds) + len(steampackages) + sum(
+            len(buildtargets) for buildtargets in butlerpackages.values()))) as executor:
+        downloads = dict()
+        for buildtargetid, build in targetbuilds.items():
+            downloads[buildtargetid] = executor.submit(run_task, download, build)
+        if not noupload:
+            for package in steampackages.keys():
+                if packagecomplete[package]['steam']:
+                    tasks.append(executor.submit(run_task, upload_steam, package))
+            for package in butlerpackages.keys():
+                if packagecomplete[package]['butler']:
+                    for buildtargetid in butlerpackages[package].keys():
+                        tasks.append(executor.submit(run_task, upload_butler, package, buildtargetid))
+
+    for future in list(downloads.values()) + tasks:
+        try:
+            returncode = future.result()
+        except Exception as e:
+            log(f"A stage of the pipeline failed: {e!r}", logtype=LOG_ERROR)
+            returncode = 15
+        if returncode != 0:
+            return returncode
+
+    if not noupload and not simulate and STEAMCMD_BUNDLE['checked']:
+        save_steamcmd_bundle()
+
+    if not settings['noclean']:
+        log("--------------------------------------------------------------------------", nodate=True)
+        log("Cleaning successfully upload build in UCB...")
+        with profile_stage('cleanup'):
+            clean_packages(packageuploadsuccess, builds, settings)
+
+    return 0
+
+
+class JobLease:
+    # lease on a job stored in S3, taken and renewed with conditional writes so only one worker owns it
+    # the clocks of the workers are never compared: a lease expires when a worker sees it unchanged (same ETag) for
+    # ttl seconds, and its owner gives it up when it could not renew it for two thirds of ttl
+    # key: lease, value: (ETag, time it was first seen with this ETag)
+    observed = dict()
+
+    def __init__(self, bucket_name, jobid, workerid, ttl=300):
+        self.bucket_name = bucket_name
+        self.key = f"{get_jobs_prefix()}{jobid}.lease"
+        self.workerid = workerid
+        self.ttl = ttl
+        self.etag = None
+        self.lost = False
+        self.renewed = None
+        self.stopevent = threading.Event()
+        self.thread = None
+
+    def acquire(self):
+        lease, etag = s3_get_json(self.bucket_name, self.key)
+        self.renewed = time.monotonic()
+        if lease is None:
+            self.etag = s3_put_json(self.bucket_name, self.key, self.get_lease(), if_none_match=True)
+        elif lease['worker'] == self.workerid or self.is_expired(etag):
+            # the lease expired (the worker died): take it over if nobody did it in the meantime
+            self.etag = s3_put_json(self.bucket_name, self.key, self.get_lease(), if_match=etag)
+        else:
+            return False
+
+        if self.etag is None:
+            return False
+
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return True
+
+    def is_expired(self, etag):
+        now = time.monotonic()
+        seen = JobLease.observed.get(self.key)
+        if seen is None or seen[0] != etag:
+            JobLease.observed[self.key] = (etag, now)
+            return False
+        return now - seen[1] >= self.ttl
+
+    def is_valid(self):
+        return not self.lost and self.renewed is not None and time.monotonic() - self.renewed < self.ttl * 2 / 3
+
+    def get_lease(self):
+        # the expiry is informative (the clock of this worker), it also gives a new ETag to each renewal
+        return {'worker': self.workerid, 'expires': time.time() + self.ttl}
+
+    def heartbeat(self):
+        while not self.stopevent.wait(self.ttl / 3):
+            renewed = time.monotonic()
+            try:
+                etag = s3_put_json(self.bucket_name, self.key, self.get_lease(), if_match=self.etag)
+            except botocore_exceptions.ClientError as e:
+                log(f"Renewing the lease {self.key} failed: {e.response['Error']['Message']}", logtype=LOG_WARNING)
+                continue
+            if etag is None:
+                self.lost = True
+                log(f"The lease {self.key} was taken by another worker", logtype=LOG_ERROR)
+                return
+            self.etag = etag
+            self.renewed = renewed
+
+    def release(self):
+        self.stopevent.set()
+        if self.thread is not None:
+            self.thread.join()
+        # a lease given up may already belong to another worker
+        if self.is_valid():
+            try:
+                s3_client().delete_object(Bucket=self.bucket_name, Key=self.key)
+            except botocore_exceptions.ClientError as e:
+                log(e.response['Error']['Message'], logtype=LOG_ERROR)
+
+
+def check_lease(settings):
+    # a worker stops the job it is processing as soon as its lease is lost: another worker may process it
+    lease = settings.get('lease')
+    if lease is not None and not lease.is_valid():
+        log(f"The lease {lease.key} was lost, the job is stopped", logtype=LOG_ERROR)
+        return False
+    return True
+
+
+def get_job_id(package, buildnumbers):
+    # the same builds always give the same job
+    signature = ",".join(f"{buildtargetid}:{build}" for buildtargetid, build in sorted(buildnumbers.items()))
+    return f"{package}-{hashlib.sha1(signature.encode('utf-8')).hexdigest()[0:12]}"
+
+
+def get_package_buildnumbers(packagevalue, platform=""):
+    # last successful build of each build target of a package
+    buildnumbers = dict()
+    for build in packagevalue['builds']:
+        if build['platform'] == platform or platform == "":
+            if int(build['build']) > int(buildnumbers.get(build['buildtargetid'], 0)):
+                buildnumbers[build['buildtargetid']] = build['build']
+    return buildnumbers
+
+
+def enqueue_jobs(packagecomplete, platform=""):
+    # create a job in S3 for each complete package, a job already created for the same builds is kept as is
+    created = 0
+    for package, packagevalue in packagecomplete.items():
+        if not packagevalue['complete']:
+            continue
+
+        buildnumbers = get_package_buildnumbers(packagevalue, platform)
+        jobid = get_job_id(package, buildnumbers)
+        job = {'id': jobid, 'package': package, 'builds': buildnumbers, 'status': 'pending',
+               'created': datetime.utcnow().isoformat()}
+        log(f" Creating job {jobid} for package {package}...", end="")
+        try:
+            etag = s3_put_json(CFG['aws']['s3bucket'], f"{get_jobs_prefix()}{jobid}.json", job,
+                               if_none_match=True)
+        except botocore_exceptions.ClientError as e:
+            log(e.response['Error']['Message'], logtype=LOG_ERROR, nodate=True)
+            continue
+        if etag is None:
+            log("OK (already created)", logtype=LOG_SUCCESS, nodate=True)
+        else:
+            created += 1
+            log("OK", logtype=LOG_SUCCESS, nodate=True)
+
+    return created
 
-    if logtype == LOG_ERROR or logtype == LOG_WARNING or logtype == LOG_SUCCESS:
-        strprint = strprint + f"{Style.RESET_ALL}"
-        strfile = strfile + "</font>"
 
-    if end == "":
-        print(strprint, end="")
-    else:
-        print(strprint)
-    if not DEBUG_FILE.closed:
-        if end == "":
-            DEBUG_FILE.write(strfile)
-            DEBUG_FILE.flush()
+def run_job(jobid, workerid, settings):
+    # claim a job, process its package then release it
+    # return None when the job could not be claimed, the return code of the processing otherwise
+    jobkey = f"{get_jobs_prefix()}{jobid}.json"
+    lease = JobLease(CFG['aws']['s3bucket'], jobid, workerid, get_config_value(['jobs', 'lease_ttl'], 300))
+    if not lease.acquire():
+        return None
+
+    try:
+        # the job may have been finished between the listing and the claim
+        job, etag = s3_get_json(CFG['aws']['s3bucket'], jobkey)
+        if job is None or job['status'] != 'pending':
+            return None
+
+        log("--------------------------------------------------------------------------", nodate=True)
+        log(f"Worker {workerid} processing job {jobid} (package {job['package']})...")
+        allbuilds = get_builds(settings['platform'])
+        steampackages, butlerpackages, packagecomplete = get_packages(allbuilds, settings['platform'])
+        if job['package'] not in packagecomplete or not packagecomplete[job['package']]['complete'] or \
+                get_package_buildnumbers(packagecomplete[job['package']], settings['platform']) != job['builds']:
+            log(f" The builds of package {job['package']} changed since the job was created", logtype=LOG_WARNING)
+            job['status'] = 'obsolete'
+            returncode = 0
         else:
-            DEBUG_FILE.write(strfile + '</br>' + end)
-            DEBUG_FILE.flush()
+            returncode = deploy_packages([job['package']], steampackages, butlerpackages, packagecomplete,
+                                         classify_builds(allbuilds), dict(settings, lease=lease))
+            job['status'] = 'done' if returncode == 0 else 'failed'
+
+        job['worker'] = workerid
+        job['returncode'] = returncode
+        job['finished'] = datetime.utcnow().isoformat()
+        # the status belongs to the worker that took the job over
+        if not check_lease({'lease': lease}):
+            return 60
+        s3_put_json(CFG['aws']['s3bucket'], jobkey, job)
+        return returncode
+    finally:
+        lease.release()
+
+
+def run_worker(settings):
+    # process the pending jobs until none of them can be claimed
+    workerid = f"{socket.gethostname()}-{os.getpid()}"
+    returncode = 0
+    client = s3_client()
+    prefix = get_jobs_prefix()
+
+    while True:
+        jobids = list()
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=CFG['aws']['s3bucket'], Prefix=prefix):
+            for obj in page.get('Contents', list()):
+                # the jobs of the other projects are in sub folders
+                if obj['Key'].endswith('.json') and '/' not in obj['Key'][len(prefix):]:
+                    jobids.append(obj['Key'][len(prefix):-len('.json')])
+
+        processed = False
+        for jobid in sorted(jobids):
+            job, etag = s3_get_json(CFG['aws']['s3bucket'], f"{prefix}{jobid}.json")
+            if job is None or job['status'] != 'pending':
+                continue
+            jobreturncode = run_job(jobid, workerid, settings)
+            if jobreturncode is None:
+                continue
+            processed = True
+            if jobreturncode != 0:
+                returncode = jobreturncode
+            # list the jobs again: other workers may have taken some of them in the meantime
+            break
 
+        if not processed:
+            break
 
-def print_help():
-    print(
-        f"UCB-steam.py --platform=(standalonelinux64, standaloneosxuniversal, standalonewindows64) [--branch=(prod, beta, develop)] [--nolive] [--force] [--version=<version>] [--install] [--nodownload] [--noupload] [--noclean] [--noshutdown] [--noemail] [--steamuser=<steamuser>] [--steampassword=<steampassword>]")
+    log(f"Worker {workerid}: no more job to claim")
+    return returncode
 
 
 def main(argv):
@@ -416,16 +3841,20 @@ def main(argv):
     install = False
     nolive = False
     simulate = False
+    trigger = False
+    gitbranch = ""
+    wait = get_config_value(['unity', 'wait', 'enabled'], False)
+    enqueue = False
+    worker = False
+    noresume = False
+    stats = False
+    frombackup = False
     try:
-        options, arguments = getopt.getopt(argv, "hldocsfip:b:lv:t:u:a:",
-                                   ["help", "nolive", "nodownload", "noupload", "noclean", "noshutdown", "noemail",
-                                    "force", "install", "simulate", "platform=", "branch=", "version=",
-                                    "steamuser=",
-                                    "steampassword="])
+        options, arguments = getopt.getopt(argv, SHORT_OPTIONS, LONG_OPTIONS)
     except getopt.GetoptError:
         return 10
 
-    for option, argument in opts:
+    for option, argument in options:
         if option in ("-h", "--help"):
             print_help()
             return 10
@@ -462,10 +3891,41 @@ def main(argv):
             CFG['steam']['user'] = argument
         elif option in ("-a", "--steampassword"):
             CFG['steam']['password'] = argument
-
-    buildpath = CFG['basepath'] + '/Steam/build'
-    packageuploadsuccess = dict()
-    packagecomplete = dict()
+        elif option == "--trigger":
+            trigger = True
+        elif option == "--gitbranch":
+            gitbranch = argument
+        elif option == "--wait":
+            wait = True
+        elif option == "--enqueue":
+            enqueue = True
+        elif option == "--worker":
+            worker = True
+        elif option == "--noresume":
+            noresume = True
+        elif option == "--stats":
+            stats = True
+        elif option == "--from-backup":
+            frombackup = True
+
+    if stats:
+        return print_history_statistics()
+
+    # jobs.mode: worker, set on the instances started together by the webhook, makes them share the packages as jobs
+    # instead of each of them deploying (and cleaning) the same packages
+    if not (trigger or enqueue or worker or install or frombackup) and \
+            get_config_value(['jobs', 'mode'], 'deploy') == 'worker':
+        worker = True
+
+    mode = 'deploy'
+    if trigger:
+        mode = 'trigger'
+    elif worker:
+        mode = 'worker'
+    elif enqueue:
+        mode = 'enqueue'
+    record_metric('run', 'settings', {'mode': mode, 'platform': platform, 'branch': steam_appbranch,
+                                      'simulate': simulate})
 
     # region INSTALL
     # install all the dependencies and test them
@@ -597,6 +4057,9 @@ def main(argv):
             return 21
         log("OK", logtype=LOG_SUCCESS, nodate=True)
 
+        # a steamcmd already updated and logged in by another instance is used before the SDK
+        restore_steamcmd_bundle()
+
         log("Downloadng Steamworks SDK...", end="")
         if not os.path.exists(f"{CFG['basepath']}/Steam/steamcmd/linux32/steamcmd"):
             ok = s3_download_directory("UCB/steam-sdk", CFG['aws']['s3bucket'], f"{CFG['basepath']}/steam-sdk")
@@ -623,6 +4086,7 @@ def main(argv):
             log("Error connecting to Steam", logtype=LOG_ERROR, nodate=True)
             return 23
         log("OK", logtype=LOG_SUCCESS, nodate=True)
+        save_steamcmd_bundle()
 
         log("Creating folder structure for Butler...", end="")
         if not os.path.exists(CFG['homepath'] + '/.config'):
@@ -660,12 +4124,32 @@ def main(argv):
         return 0
     # endregion
 
+    # the stages completed by an interrupted run are not done again, unless --noresume is used
+    if noresume and not simulate:
+        get_journal().reset()
+
+    # region TRIGGER
+    if trigger:
+        return trigger_builds(steam_appbranch, gitbranch, simulate)
+    # endregion
+
     # Get all the successful builds from Unity Cloud Build
     build_filter = ""
     if platform != "":
         build_filter = f"(Filtering on platform:{platform})"
-    log(f"Retrieving all the builds information {build_filter}...", end="")
-    allbuilds = get_all_builds("", platform)
+    if frombackup:
+        # redeploy the builds backed up in S3: UCB is not used, nothing is cleaned there and nothing is waited for
+        if steam_appbranch == "":
+            log("--from-backup needs the branch of the backup (--branch)", logtype=LOG_ERROR)
+            return 10
+        noclean = True
+        wait = False
+        log(f"Retrieving the builds backed up for {steam_appbranch} {build_filter}...", end="")
+        allbuilds = get_backup_builds(steam_appbranch, platform)
+    else:
+        log(f"Retrieving all the builds information {build_filter}...", end="")
+        with profile_stage('get_all_builds'):
+            allbuilds = get_builds(platform)
     if len(allbuilds) == 0:
         log("Retrieving the information. No build available in UCB", logtype=LOG_ERROR, nodate=True)
         if force:
@@ -673,26 +4157,7 @@ def main(argv):
         else:
             return 3
 
-    # filter on successful builds only
-    builds = dict()
-    builds['success'] = list()
-    builds['building'] = list()
-    builds['failure'] = list()
-    builds['canceled'] = list()
-    builds['unknown'] = list()
-
-    for build in allbuilds:
-        if build['buildStatus'] == 'success':
-            builds['success'].append(build)
-        elif build['buildStatus'] == 'queued' or build['buildStatus'] == 'sentToBuilder' or build[
-            'buildStatus'] == 'started' or build['buildStatus'] == 'restarted':
-            builds['building'].append(build)
-        elif build['buildStatus'] == 'failure':
-            builds['failure'].append(build)
-        elif build['buildStatus'] == 'canceled':
-            builds['canceled'].append(build)
-        else:
-            builds['unknown'].append(build)
+    builds = classify_builds(allbuilds)
 
     log("OK", logtype=LOG_SUCCESS, nodate=True)
     log(f" {len(builds['success'])} builds are waiting for processing")
@@ -705,104 +4170,27 @@ def main(argv):
     if len(builds['unknown']) > 0:
         log(f" {len(builds['unknown'])} builds are in a unknown state")
 
-    # build package structure for consistency check
-    # region STEAM
-    steampackages = dict()
-    for buildtarget in CFG['buildtargets']:
-        for buildtargetid in buildtarget.keys():
-            if 'steam' in buildtarget[buildtargetid]:
-                if 'package' in buildtarget[buildtargetid]['steam']:
-                    package = buildtarget[buildtargetid]['steam']['package']
-                    if package not in steampackages:
-                        steampackages[package] = dict()
-
-                    steampackages[package][buildtargetid] = dict()
-                    steampackages[package][buildtargetid]['complete'] = False
-
-    for build in allbuilds:
-        if build['platform'] == platform or platform == "":
-            buildtargetid = build['buildtargetid']
-            for buildtarget in CFG['buildtargets']:
-                if buildtargetid in buildtarget.keys():
-                    if 'steam' in buildtarget[buildtargetid]:
-                        if 'package' in buildtarget[buildtargetid]['steam']:
-                            package = buildtarget[buildtargetid]['steam']['package']
-
-                            if build['buildStatus'] == 'success':
-                                steampackages[package][buildtargetid]['complete'] = True
-
-                            if 'builds' not in steampackages[package][buildtargetid]:
-                                steampackages[package][buildtargetid]['builds'] = list()
-                            steampackages[package][buildtargetid]['builds'].append(build)
-
-    # identify the full completion of a package (based on the configuration)
-    for package in steampackages.keys():
-        if package not in packagecomplete.keys():
-            packagecomplete[package] = dict()
-            packagecomplete[package]['complete'] = True
-            packagecomplete[package]['builds'] = list()
-
-        packagecomplete[package]['steam'] = True
-
-        for buildtargetid, buildtargetvalue in steampackages[package].items():
-            if 'builds' in buildtargetvalue:
-                for build in buildtargetvalue['builds']:
-                    if build not in packagecomplete[package]['builds'] and build['buildStatus'] == 'success':
-                        packagecomplete[package]['builds'].append(build)
-
-            if not buildtargetvalue['complete']:
-                packagecomplete[package]['steam'] = False
-                packagecomplete[package]['complete'] = False
-    # endregion
-
-    # region BUTLER
-    butlerpackages = dict()
-    for buildtarget in CFG['buildtargets']:
-        for buildtargetid in buildtarget.keys():
-            if 'butler' in buildtarget[buildtargetid]:
-                if 'package' in buildtarget[buildtargetid]['butler']:
-                    package = buildtarget[buildtargetid]['butler']['package']
-                    if package not in butlerpackages:
-                        butlerpackages[package] = dict()
-
-                    butlerpackages[package][buildtargetid] = dict()
-                    butlerpackages[package][buildtargetid]['complete'] = False
-
-    for build in allbuilds:
-        if build['platform'] == platform or platform == "":
-            buildtargetid = build['buildtargetid']
-            for buildtarget in CFG['buildtargets']:
-                if buildtargetid in buildtarget.keys():
-                    if 'butler' in buildtarget[buildtargetid]:
-                        if 'package' in buildtarget[buildtargetid]['butler']:
-                            package = buildtarget[buildtargetid]['butler']['package']
-
-                            if build['buildStatus'] == 'success':
-                                butlerpackages[package][buildtargetid]['complete'] = True
-
-                            if 'builds' not in butlerpackages[package][buildtargetid]:
-                                butlerpackages[package][buildtargetid]['builds'] = list()
-                            butlerpackages[package][buildtargetid]['builds'].append(build)
-
-    # identify the full completion of a package (based on the configuration)
-    for package in butlerpackages.keys():
-        if package not in packagecomplete.keys():
-            packagecomplete[package] = dict()
-            packagecomplete[package]['complete'] = True
-            packagecomplete[package]['builds'] = list()
-
-        packagecomplete[package]['butler'] = True
-
-        for buildtargetid, buildtargetvalue in butlerpackages[package].items():
-            if 'builds' in buildtargetvalue:
-                for build in buildtargetvalue['builds']:
-                    if build not in packagecomplete[package]['builds'] and build['buildStatus'] == 'success':
-                        packagecomplete[package]['builds'].append(build)
+    with profile_stage('get_packages'):
+        # the builds restored from the backup are deployed again on purpose
+        steampackages, butlerpackages, packagecomplete = get_packages(allbuilds, platform, not frombackup)
 
-            if not buildtargetvalue['complete']:
-                packagecomplete[package]['butler'] = False
-                packagecomplete[package]['complete'] = False
+    settings = {'platform': platform, 'branch': steam_appbranch, 'version': steam_appversion,
+                'nodownload': nodownload, 'noupload': noupload, 'noclean': noclean, 'force': force, 'nolive': nolive,
+                'simulate': simulate, 'frombackup': frombackup}
 
+    # region JOBS
+    # distribute the packages across several workers through S3
+    if enqueue or worker:
+        log("--------------------------------------------------------------------------", nodate=True)
+        log("Creating jobs for the complete packages...")
+        enqueue_jobs(packagecomplete, platform)
+        if worker:
+            returncode = run_worker(settings)
+            if returncode != 0:
+                return returncode
+        log("--------------------------------------------------------------------------", nodate=True)
+        log("All done!")
+        return 0
     # endregion
 
     cancontinue = False
@@ -813,338 +4201,105 @@ def main(argv):
     log(" One or more packages complete...", end="")
     if cancontinue:
         log("OK", nodate=True, logtype=LOG_SUCCESS)
+    elif wait and len(builds['building']) > 0:
+        log(f"Waiting for the builds in progress (--wait flag used)", nodate=True, logtype=LOG_WARNING)
     elif force:
         log(f"Process forced to continue (--force flag used)", nodate=True, logtype=LOG_WARNING)
     else:
         log("At least one package must be complete to proceed to the next step", nodate=True, logtype=LOG_ERROR)
         return 4
 
-    # download the builds from UCB
-    if not nodownload:
-        log("--------------------------------------------------------------------------", nodate=True)
-        log("Downloading build from UCB...")
+    if not wait and get_config_value(['disk', 'budget'], 0) > 0:
+        completepackages = list()
         for package, packagevalue in packagecomplete.items():
-            for build in packagevalue['builds']:
-                # filter on the platform we want (if platform is empty, it means that we must do it for all
-                if build['platform'] == platform or platform == "":
-                    # store the data necessary for the next steps
-                    buildtargetid = build['buildtargetid']
-                    buildospath = buildpath + '/' + buildtargetid
-
-                    if buildtargetid == "":
-                        log(" Missing field", logtype=LOG_ERROR)
-                        return 5
-
-                    if not simulate:
-                        if os.path.exists(f"{buildospath}/{buildtargetid}_build.txt"):
-                            os.remove(f"{buildospath}/{buildtargetid}_build.txt")
-
-                    log(f" Preparing {buildtargetid}")
-                    if "build" not in build:
-                        log(" Missing builds field", logtype=LOG_ERROR, nodate=True)
-                        return 6
-                    downloadlink = build['links']['download_primary']['href']
-                    buildid = build['build']
-
-                    if build['finished'] == "":
-                        log(" The build seems to be a failed one", logtype=LOG_ERROR, nodate=True)
-                        return 7
-                    finisheddate = datetime.strptime(build['finished'], "%Y-%m-%dT%H:%M:%S.%fZ")
-                    currentdate = datetime.now()
-                    timediff = currentdate - finisheddate
-                    timediffinminute = int(timediff.total_seconds() / 60)
-                    log(f"  Continuing with build #{buildid} for {buildtargetid} finished {timediffinminute} minutes ago...",
-                        end="")
-                    if timediffinminute > CFG['unity']['build_max_age']:
-                        if force:
-                            log(f" Process forced to continue (--force flag used)", logtype=LOG_WARNING, nodate=True)
-                        else:
-                            log(' The build is too old (max ' + str(CFG['unity']['build_max_age']) + 'min)',
-                                logtype=LOG_ERROR,
-                                nodate=True)
-                            return 8
-                    else:
-                        log(f"OK", logtype=LOG_SUCCESS, nodate=True)
-
-                    # store the buildtargetid in a txt file for the late cleaning process
-                    if not simulate:
-                        if os.path.exists(f"{buildpath}/{buildtargetid}_build.txt"):
-                            os.remove(f"{buildpath}/{buildtargetid}_build.txt")
-                        write_in_file(f"{buildpath}/{buildtargetid}_build.txt", f"{buildtargetid}::{buildid}")
-
-                    zipfile = CFG['basepath'] + '/ucb' + buildtargetid + '.zip'
-
-                    log(f"  Deleting old files in {buildospath}...", end="")
-                    if not simulate:
-                        if os.path.exists(zipfile):
-                            os.remove(zipfile)
-                        if os.path.exists(buildospath):
-                            shutil.rmtree(buildospath, ignore_errors=True)
-                    log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-                    log('  Downloading the built zip file ' + zipfile + '...', end="")
-                    if not simulate:
-                        urllib.request.urlretrieve(downloadlink, zipfile)
-                    log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-                    log('  Extracting the zip file in ' + buildospath + '...', end="")
-                    if not simulate:
-                        with ZipFile(zipfile, "r") as zipObj:
-                            zipObj.extractall(buildospath)
-                            log("OK", logtype=LOG_SUCCESS, nodate=True)
-                    else:
-                        log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-                    s3path = 'UCB/unity-builds/' + steam_appbranch + '/ucb' + buildtargetid + '.zip'
-                    log('  Uploading copy to S3 ' + s3path + ' ...', end="")
-                    if not simulate:
-                        ok = s3_upload_file(zipfile, CFG['aws']['s3bucket'], s3path)
-                    else:
-                        ok = 0
-
-                    if ok != 0:
-                        log('Error uploading file "ucb' + buildtargetid + '.zip" to AWS ' + s3path + '. Check the IAM permissions',
-                            logtype=LOG_ERROR, nodate=True)
-                        return 9
-                    log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-    log("--------------------------------------------------------------------------", nodate=True)
-    log("Get version from source file...")
-    for package, packagevalue in packagecomplete.items():
-        for build in packagevalue['builds']:
-            buildtargetid = build['buildtargetid']
-            buildospath = buildpath + '/' + buildtargetid
-
-            if steam_appversion == "":
-                log('  Get the version of the build from files...', end="")
-                pathFileVersion = glob.glob(buildospath + "/**/UCB_version.txt", recursive=True)
-
-                if len(pathFileVersion) == 1:
-                    if os.path.exists(pathFileVersion[0]):
-                        steam_appversion = read_from_file(pathFileVersion[0])
-                        steam_appversion = steam_appversion.rstrip('\n')
-                        if not simulate:
-                            os.remove(pathFileVersion[0])
-
-                    if steam_appversion != "":
-                        log(" " + steam_appversion + " ", logtype=LOG_INFO, nodate=True, end="")
-                        log("OK ", logtype=LOG_SUCCESS, nodate=True)
-                else:
-                    log(f"File version UCB_version.txt was not found in build directory {buildospath}",
-                        logtype=LOG_WARNING, nodate=True)
-
-    if not noupload:
-        log("--------------------------------------------------------------------------", nodate=True)
-        log("Uploading files to stores...")
-
-        # region STEAM
-        # create the structure used to identify the upload success for a complete package
-        for package, packagevalue in steampackages.items():
-            if packagecomplete[package]['steam']:
-                if package not in packageuploadsuccess:
-                    packageuploadsuccess[package] = dict()
-
-                for buildtarget in CFG['buildtargets']:
-                    for buildtargetid in buildtarget.keys():
-                        if 'steam' in buildtarget[buildtargetid]:
-                            if buildtarget[buildtargetid]['steam']['package'] == package:
-                                if buildtargetid not in packageuploadsuccess[package]:
-                                    packageuploadsuccess[package][buildtargetid] = dict()
-                                packageuploadsuccess[package][buildtargetid]['steam'] = False
-
-        for package in steampackages.keys():
-            first = True
-            # we only want to build the packages that are complete
-            if packagecomplete[package]['steam']:
-                log(f'Starting Steam process for package {package}...')
-                app_id = ""
-
-                for buildtargetid in steampackages[package].keys():
-                    # TODO
-                    # filter on the platform we want (if platform is empty, it means that we must do it for all
-                    # if build['platform'] == platform or platform == "":
-                    # store the data necessary for the next steps
-
-                    # find the data related to the branch we want to build
-                    for buildtarget in CFG['buildtargets']:
-                        if buildtargetid in buildtarget.keys():
-                            if 'steam' in buildtarget[buildtargetid]:
-                                package = buildtarget[buildtargetid]['steam']['package']
-                                depot_id = buildtarget[buildtargetid]['steam']['depot_id']
-                                branch_name = buildtarget[buildtargetid]['steam']['branch_name']
-                                live = buildtarget[buildtargetid]['steam']['live']
-
-                                # now prepare the steam files
-                                # first time we loop: prepare the main steam file
-                                if first:
-                                    first = False
-
-                                    app_id = buildtarget[buildtargetid]['steam']['app_id']
-                                    log(f' Preparing main Steam file for app {app_id}...', end="")
-                                    if not simulate:
-                                        shutil.copyfile(f"{CFG['basepath']}/Steam/scripts/template_app_build.vdf",
-                                                        f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf")
-
-                                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                        "%basepath%", CFG['basepath'])
-                                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                        "%version%", steam_appversion)
-                                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                        "%branch_name%", branch_name)
-                                        replace_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                        "%app_id%", app_id)
-
-                                        if not nolive:
-                                            replace_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                            "%live%", live)
-                                        else:
-                                            replace_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                            "%live%", "")
-                                    log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-                                    # then the depot files
-                                log(f' Preparing platform Steam file for depot {depot_id} / {buildtargetid}...', end="")
-                                if not simulate:
-                                    shutil.copyfile(
-                                        f"{CFG['basepath']}/Steam/scripts/template_depot_build_buildtarget.vdf",
-                                        f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf")
-
-                                    replace_in_file(f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf",
-                                                    "%depot_id%", depot_id)
-                                    replace_in_file(f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf",
-                                                    "%buildtargetid%", buildtargetid)
-                                    replace_in_file(f"{CFG['basepath']}/Steam/scripts/depot_build_{buildtargetid}.vdf",
-                                                    "%basepath%", CFG['basepath'])
-
-                                    data = vdf.load(open(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf"))
-                                    data['appbuild']['depots'][depot_id] = f"depot_build_{buildtargetid}.vdf"
-
-                                    indented_vdf = vdf.dumps(data, pretty=True)
-
-                                    write_in_file(f"{CFG['basepath']}/Steam/scripts/app_build_{app_id}.vdf",
-                                                  indented_vdf)
-
-                                packageuploadsuccess[package][buildtargetid]['steam'] = True
-
-                                log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-                log(" Building Steam packages...", end="")
-                if app_id != "":
-                    cmd = f'{CFG["basepath"]}/Steam/steamcmd/steamcmd.sh +login "{CFG["steam"]["user"]}" "{CFG["steam"]["password"]}" +run_app_build {CFG["basepath"]}/Steam/scripts/app_build_{app_id}.vdf +quit'
-                    if not simulate:
-                        ok = os.system(cmd)
-                    else:
-                        ok = 0
-
-                    if ok != 0:
-                        log(f" Executing the bash file {CFG['basepath']}/Steam/steamcmd/steamcmd.sh (exitcode={ok})",
-                            logtype=LOG_ERROR, nodate=True)
-                        return 9
-                    log("OK", logtype=LOG_SUCCESS, nodate=True)
-
-                    if simulate:
-                        log("  " + cmd)
-                else:
-                    log("app_id is empty", logtype=LOG_ERROR, nodate=True)
-                    return 9
-            else:
-                log(f' Package {package} is not complete and will not be processed for Steam...', logtype=LOG_WARNING)
-        # endregion
-
-        # region BUTLER
-        # create the structure used to identify the upload success for a package
-        for package, packagevalue in butlerpackages.items():
-            if packagecomplete[package]['butler']:
-                if package not in packageuploadsuccess:
-                    packageuploadsuccess[package] = dict()
-
-                for buildtarget in CFG['buildtargets']:
-                    for buildtargetid in buildtarget.keys():
-                        if 'butler' in buildtarget[buildtargetid]:
-                            if buildtarget[buildtargetid]['butler']['package'] == package:
-                                if buildtargetid not in packageuploadsuccess[package]:
-                                    packageuploadsuccess[package][buildtargetid] = dict()
-                                packageuploadsuccess[package][buildtargetid]['butler'] = False
-
-        for package in butlerpackages.keys():
-            # we only want to build the packages that are complete
-            if packagecomplete[package]['butler']:
-                log(f'Starting Butler process for package {package}...')
-
-                for buildtargetid in butlerpackages[package].keys():
-                    # TODO
-                    # filter on the platform we want (if platform is empty, it means that we must do it for all
-                    # if build['platform'] == platform or platform == "":
-                    # store the data necessary for the next steps
-
-                    found = False
-                    # find the data related to the branch we want to build
-                    for buildtarget in CFG['buildtargets']:
-                        if buildtargetid in buildtarget.keys():
-                            if 'butler' in buildtarget[buildtargetid]:
-                                package = buildtarget[buildtargetid]['butler']['package']
-                                butler_channel = buildtarget[buildtargetid]['butler']['channel']
-                                buildpath = f"{CFG['basepath']}/Steam/build/{buildtargetid}"
-
-                                log(f" Building itch.io(Butler) {buildtargetid} packages...", end="")
-                                cmd = f"{CFG['basepath']}/Butler/butler push {buildpath} {CFG['butler']['org']}/{CFG['butler']['project']}:{butler_channel} --userversion={steam_appversion} --if-changed"
-                                if not simulate:
-                                    ok = os.system(cmd)
-                                else:
-                                    ok = 0
-
-                                if ok != 0:
-                                    log(f"Executing Butler {CFG['basepath']}/Butler/butler (exitcode={ok})",
-                                        logtype=LOG_ERROR)
-                                    return 10
-
-                                found = True
-
-                                packageuploadsuccess[package][buildtargetid]['butler'] = True
-
-                                log("OK", logtype=LOG_SUCCESS, nodate=True)
+            if packagevalue['complete']:
+                completepackages.append(package)
+        returncode = deploy_packages(completepackages, steampackages, butlerpackages, packagecomplete, builds,
+                                     settings)
+        if returncode != 0:
+            return returncode
+    elif not wait:
+        returncode = process_packages(packagecomplete, steampackages, butlerpackages, builds, settings)
+        if returncode != 0:
+            return returncode
+    else:
+        # only the complete packages are processed now, the other ones are processed when their builds are done
+        processed = list()
+        for package, packagevalue in packagecomplete.items():
+            if packagevalue['complete']:
+                processed.append(package)
 
-                                if simulate:
-                                    log("  " + cmd)
+        if len(processed) > 0:
+            returncode = deploy_packages(processed, steampackages, butlerpackages, packagecomplete, builds, settings)
+            if returncode != 0:
+                return returncode
 
-                    if not found:
-                        log(f"There is no Butler configuration for the target {buildtargetid}", logtype=LOG_WARNING)
-            else:
-                log(f' Package {package} is not complete and will not be processed for Butler...', logtype=LOG_WARNING)
-        # endregion
+        returncode = wait_for_packages(allbuilds, processed, settings)
+        if returncode != 0:
+            return returncode
 
-    if not noclean:
-        log("--------------------------------------------------------------------------", nodate=True)
-        log("Cleaning successfully upload build in UCB...")
-        # let's remove the build successfully uploaded to Steam or Butler from UCB
-        # clean only the packages that are successful
-        for package, packagevalue in packageuploadsuccess.items():
-            complete = True
-            for buildtarget, buildtargetvalue in packagevalue.items():
-                for uploadprocess, uploadprocessvalue in buildtargetvalue.items():
-                    if not uploadprocessvalue:
-                        complete = False
-
-            if complete:
-                log(f" Cleaning package {package}...")
-                # cleanup everything related to this package
-
-                for build in builds['success'] + builds['building'] + builds['failure'] + builds['canceled']:
-                    for buildtarget in packagevalue.keys():
-                        if build['buildtargetid'] == buildtarget:
-                            buildid = build['build']
-                            log(f"  Deleting build #{buildid} for buildtarget {buildtarget} (status: {build['buildStatus']})...",
-                                end="")
-                            if not simulate:
-                                delete_build(buildtarget, buildid)
-                            log("OK", logtype=LOG_SUCCESS, nodate=True)
+        if len(processed) == 0 and not force:
+            log("No package was completed while waiting", logtype=LOG_ERROR)
+            return 4
 
     log("--------------------------------------------------------------------------", nodate=True)
     log("All done!")
     return 0
 
 
+def run_projects(argv):
+    # the projects are deployed one after the other in the same run: the UCB session, the S3 clients, the caches and
+    # the concurrency limits are shared, and the log of all of them is sent as one report
+    global CFG
+    global JOURNAL
+    projects = get_project_configs(CFG)
+    if projects is None:
+        return 11
+    if len(projects) == 0:
+        return main(argv)
+
+    baseconfig = CFG
+    # --install and --stats do not depend on the project: they are run once
+    try:
+        opts, args = getopt.getopt(argv, SHORT_OPTIONS, LONG_OPTIONS)
+    except getopt.GetoptError:
+        opts = list()
+    if any(option in ("-i", "--install", "--stats") for option, argument in opts):
+        CFG = projects[0]
+        returncode = main(argv)
+        CFG = baseconfig
+        return returncode
+
+    results = list()
+    returncode = 0
+    for projectconfig in projects:
+        CFG = projectconfig
+        with JOURNAL_LOCK:
+            JOURNAL = None
+        log("==========================================================================", nodate=True)
+        log(f"Project {CFG['project']}")
+        projectreturncode = main(argv)
+        results.append((CFG['project'], projectreturncode))
+        if projectreturncode == 10:
+            # help or invalid option: the same for every project
+            returncode = 10
+            break
+        if projectreturncode != 0 and returncode == 0:
+            returncode = projectreturncode
+    CFG = baseconfig
+
+    log("==========================================================================", nodate=True)
+    for project, projectreturncode in results:
+        if projectreturncode == 0:
+            log(f" Project {project}: OK", logtype=LOG_SUCCESS)
+        else:
+            log(f" Project {project}: failed with code {projectreturncode}", logtype=LOG_ERROR)
+    return returncode
+
+
 if __name__ == "__main__":
+    interpreter_time = time.process_time()
+    config_start = time.time()
     # load the configuration from the config file
     currentpath = os.path.dirname(os.path.abspath(__file__))
     with open(currentpath + '/UCB-steam.config', "r") as ymlfile:
@@ -1161,16 +4316,15 @@ if __name__ == "__main__":
     DEBUG_FILE_NAME = CFG['logpath'] + '/' + datetime.now().strftime("%Y%m%d_%H%M%S") + '.html'
     # open the logfile for writing
     DEBUG_FILE = open(DEBUG_FILE_NAME, "wt")
+    config_time = time.time() - config_start
 
     codeok = 0
     noshutdown = False
     noemail = False
+    stats = False
+    profilestartup = False
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hldocsfip:b:lv:t:u:a:",
-                                   ["help", "nolive", "nodownload", "noupload", "noclean", "noshutdown", "noemail",
-                                    "force", "install", "simulate", "platform=", "branch=", "version=",
-                                    "steamuser=",
-                                    "steampassword="])
+        opts, args = getopt.getopt(sys.argv[1:], SHORT_OPTIONS, LONG_OPTIONS)
         for opt, arg in opts:
             if opt in ("-s", "--noshutdown"):
                 noshutdown = True
@@ -1178,16 +4332,34 @@ if __name__ == "__main__":
                 noemail = True
             elif opt in ("-i", "--install"):
                 noshutdown = True
+            elif opt == "--stats":
+                # only a query on the run history
+                noshutdown = True
+                noemail = True
+                stats = True
+            elif opt == "--profilestartup":
+                profilestartup = True
+            elif opt == "--profile":
+                PROFILE['enabled'] = True
+            elif opt == "--trigger":
+                # run by hand (the startup script gives no option) and waiting for the builds up to
+                # unity.trigger.timeout minutes: the instance is left running for the next deployment
+                noshutdown = True
     except getopt.GetoptError:
         print_help()
         codeok = 11
 
     if codeok != 10 and codeok != 11:
-        codeok = main(sys.argv[1:])
+        codeok = run_projects(sys.argv[1:])
         if not noshutdown and codeok != 10:
             log("Shutting down computer...")
             os.system("sudo shutdown +3")
 
+    if profilestartup:
+        log_startup_profile(interpreter_time, config_time)
+    log_run_metrics()
+    if codeok != 10 and codeok != 11 and not stats:
+        save_run_history(codeok)
     log("--- Script execution time : %s seconds ---" % (time.time() - start_time))
     # close the logfile
     DEBUG_FILE.close()